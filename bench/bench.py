@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Load generator for otto, writing a JSON report per run.
+
+    $ python bench/bench.py --spawn FsObjectStorage --report fs.json
+    $ python bench/bench.py --spawn RiakObjectStorage --report riak.json
+    $ python bench/bench.py --url http://127.0.0.1:8080 --sizes 1024 --concurrency 64
+    $ python bench/compare.py fs-0.0.3.json fs-0.0.4.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import shutil
+import signal
+import tempfile
+import platform
+import subprocess
+from optparse import OptionParser
+from StringIO import StringIO
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.web import client
+from twisted.web.http_headers import Headers
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+def summarize(name, samples, errors, elapsed, transferred = 0, **extra):
+    samples = sorted(samples)
+    result = {
+                'name': name,
+                'operations': len(samples),
+                'errors': errors,
+                'elapsed': elapsed,
+                'ops_per_second': elapsed and len(samples) / elapsed or 0,
+                'bytes_per_second': elapsed and transferred / elapsed or 0,
+                'latency': {
+                    'min': samples and samples[0] or None,
+                    'mean': samples and sum(samples) / len(samples) or None,
+                    'p50': percentile(samples, 0.50),
+                    'p90': percentile(samples, 0.90),
+                    'p99': percentile(samples, 0.99),
+                    'p999': percentile(samples, 0.999),
+                    'max': samples and samples[-1] or None,
+                },
+             }
+    result.update(extra)
+    print '%-40s %8d ops %6d err %10.1f ops/s  p50 %7.2fms  p99 %7.2fms' % (
+            name, len(samples), errors, result['ops_per_second'],
+            (result['latency']['p50'] or 0) * 1000, (result['latency']['p99'] or 0) * 1000)
+    return result
+
+class Client(object):
+    def __init__(self, url, concurrency):
+        self.url = url.rstrip('/')
+        self.pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = concurrency
+        self.agent = client.Agent(reactor, pool=self.pool)
+
+    @defer.inlineCallbacks
+    def request(self, method, path, body = None):
+        producer = body is not None and client.FileBodyProducer(StringIO(body)) or None
+        started = time.time()
+        response = yield self.agent.request(method, self.url + path, Headers(), producer)
+        data = yield client.readBody(response)
+        if response.code >= 400:
+            raise Exception('%s %s answered %d' % (method, path, response.code))
+        defer.returnValue((time.time() - started, len(data)))
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+@defer.inlineCallbacks
+def run_operations(name, client, operations, concurrency, **extra):
+    """operations is a list of (method, path, body); run them concurrency at a time"""
+    samples = []
+    errors = [0]
+    transferred = [0]
+    work = iter(operations)
+
+    @defer.inlineCallbacks
+    def worker():
+        for method, path, body in work:
+            try:
+                elapsed, received = yield client.request(method, path, body)
+            except Exception, e:
+                errors[0] += 1
+                if errors[0] <= 5:
+                    print '%s: %s' % (name, e)
+                continue
+            samples.append(elapsed)
+            transferred[0] += received + len(body or '')
+
+    started = time.time()
+    yield defer.gatherResults([worker() for _ in range(concurrency)])
+    defer.returnValue(summarize(name, samples, errors[0], time.time() - started, transferred[0], **extra))
+
+@defer.inlineCallbacks
+def bench_objects(client, options, results):
+    for size in options.sizes:
+        body = os.urandom(size)
+        for concurrency in options.concurrency:
+            bucket = '/bench-%s' % uuid.uuid4().hex[:8]
+            yield client.request('PUT', bucket + '/')
+            keys = ['%s/object-%06d' % (bucket, number) for number in range(options.requests)]
+            extra = {'size': size, 'concurrency': concurrency}
+            results.append((yield run_operations('put %db c%d' % (size, concurrency), client,
+                                                 [('PUT', key, body) for key in keys], concurrency, operation='put', **extra)))
+            results.append((yield run_operations('get %db c%d' % (size, concurrency), client,
+                                                 [('GET', key, None) for key in keys], concurrency, operation='get', **extra)))
+            results.append((yield run_operations('delete %db c%d' % (size, concurrency), client,
+                                                 [('DELETE', key, None) for key in keys], concurrency, operation='delete', **extra)))
+            yield client.request('DELETE', bucket + '/')
+
+@defer.inlineCallbacks
+def bench_listings(client, options, results):
+    concurrency = max(options.concurrency)
+    for count in options.list_keys:
+        bucket = '/bench-list-%s' % uuid.uuid4().hex[:8]
+        yield client.request('PUT', bucket + '/')
+        # 100 prefixes so prefix queries select about 1% of the bucket
+        keys = ['%s/p%02d/object-%08d' % (bucket, number % 100, number) for number in range(count)]
+        results.append((yield run_operations('seed %d keys' % count, client,
+                                             [('PUT', key, '') for key in keys], concurrency,
+                                             operation='seed', keys=count)))
+        queries = []
+        for number in range(options.list_requests):
+            marker = 'p%02d/object-%08d' % ((number * 37) % 100, (number * 7919) % count)
+            queries.append(('full', '%s?max-keys=%d' % (bucket, options.page_size)))
+            queries.append(('prefix', '%s?prefix=p%02d/&max-keys=%d' % (bucket, number % 100, options.page_size)))
+            queries.append(('marker', '%s?marker=%s&max-keys=%d' % (bucket, marker, options.page_size)))
+            queries.append(('terse', '%s?marker=%s&terse=1&max-keys=%d' % (bucket, marker, options.page_size)))
+        for kind in ('full', 'prefix', 'marker', 'terse'):
+            results.append((yield run_operations('list %s %d keys' % (kind, count), client,
+                                                 [('GET', path, None) for _kind, path in queries if _kind == kind],
+                                                 concurrency, operation='list', listing=kind, keys=count,
+                                                 page_size=options.page_size)))
+        if options.cleanup:
+            yield run_operations('cleanup %d keys' % count, client, [('DELETE', key, None) for key in keys], concurrency)
+            yield client.request('DELETE', bucket + '/')
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for(port, timeout = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise Exception('Nothing listening on port %d after %ds' % (port, timeout))
+
+class LocalOtto(object):
+    """Runs otto, and a fake riak for RiakObjectStorage, from a scratch directory"""
+    def __init__(self, storage, workers = 1, riak_latency = 0):
+        self.directory = tempfile.mkdtemp(prefix='otto-bench-')
+        self.port = free_port()
+        self.processes = []
+        os.mkdir(os.path.join(self.directory, 'config'))
+        storage_lines = ['directory = %s' % os.path.join(self.directory, 'data'), 'io_threads = 8']
+        if storage == 'RiakObjectStorage':
+            riak_port = free_port()
+            self.spawn([sys.executable, os.path.join(ROOT, 'bench', 'fakeriak.py'), str(riak_port), str(riak_latency)], 'fakeriak.log')
+            wait_for(riak_port)
+            storage_lines = ['nodes = 127.0.0.1:%d' % riak_port]
+        with open(os.path.join(self.directory, 'config', 'otto.cfg'), 'w') as config:
+            config.write('\n'.join(['[otto]', 'Port = %d' % self.port, 'ObjectStorage = %s' % storage,
+                                    'Workers = %d' % workers, '', '[%s]' % storage] + storage_lines) + '\n')
+        shutil.copy(os.path.join(ROOT, 'src', 'otto.tac'), self.directory)
+        self.spawn(['twistd', '-n', '--pidfile=', '-l', os.path.join(self.directory, 'otto.log'), '-y', 'otto.tac'], None)
+        wait_for(self.port)
+        self.url = 'http://127.0.0.1:%d' % self.port
+
+    def spawn(self, command, log_name):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.join(ROOT, 'src'), os.environ.get('PYTHONPATH')])))
+        output = log_name and open(os.path.join(self.directory, log_name), 'w') or None
+        self.processes.append(subprocess.Popen(command, cwd=self.directory, env=env, stdout=output, stderr=output))
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except Exception:
+        return None
+
+@defer.inlineCallbacks
+def main(options):
+    local = None
+    if options.spawn:
+        local = LocalOtto(options.spawn, options.workers, options.riak_latency)
+        options.url = local.url
+    client = Client(options.url, max(options.concurrency))
+    results = []
+    started = time.time()
+    try:
+        if 'objects' in options.suites:
+            yield bench_objects(client, options, results)
+        if 'listings' in options.suites:
+            yield bench_listings(client, options, results)
+    finally:
+        yield client.close()
+        if local is not None:
+            local.stop()
+    import otto
+    report = {
+                'otto_version': otto.__version__,
+                'revision': git_revision(),
+                'storage': options.spawn,
+                'url': options.url,
+                'workers': options.workers,
+                'started': started,
+                'duration': time.time() - started,
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'results': results,
+             }
+    if options.report:
+        with open(options.report, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print 'Report written to %s' % options.report
+
+def integers(value):
+    return [int(float(item)) for item in value.split(',') if item]
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--url', default='http://127.0.0.1:8080', help='otto instance to load [%default]')
+    parser.add_option('--spawn', metavar='STORAGE', help='start a scratch otto with this ObjectStorage instead of using --url')
+    parser.add_option('--workers', type='int', default=1, help='Workers for the spawned otto [%default]')
+    parser.add_option('--riak-latency', type='float', default=0, help='seconds the fake riak waits per request [%default]')
+    parser.add_option('--suites', default='objects,listings', help='[%default]')
+    parser.add_option('--sizes', default='1024,65536,1048576', help='object sizes in bytes [%default]')
+    parser.add_option('--requests', type='int', default=500, help='objects per size and concurrency [%default]')
+    parser.add_option('--concurrency', default='1,16,64', help='concurrent clients [%default]')
+    parser.add_option('--list-keys', default='1e3,1e4', help='bucket sizes for listings, up to 1e6 [%default]')
+    parser.add_option('--list-requests', type='int', default=50, help='queries per listing kind [%default]')
+    parser.add_option('--page-size', type='int', default=1000, help='max-keys per listing [%default]')
+    parser.add_option('--no-cleanup', dest='cleanup', action='store_false', default=True)
+    parser.add_option('--report', help='write the JSON report here')
+    parser.add_option('-v', '--verbose', action='store_true')
+    options, args = parser.parse_args()
+    options.suites = options.suites.split(',')
+    options.sizes = integers(options.sizes)
+    options.concurrency = integers(options.concurrency)
+    options.list_keys = integers(options.list_keys)
+    if options.verbose:
+        log.startLogging(sys.stdout)
+
+    def run():
+        d = main(options)
+        d.addErrback(log.err)
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
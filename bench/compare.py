@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""Compares two bench.py reports and exits non-zero on regressions.
+
+    $ python bench/compare.py baseline.json candidate.json --threshold 0.1
+"""
+import sys
+import json
+from optparse import OptionParser
+
+def load(path):
+    with open(path) as report:
+        return dict((result['name'], result) for result in json.load(report)['results'])
+
+def compare(baseline, candidate, threshold):
+    regressions = []
+    print '%-40s %12s %12s %8s %10s %10s %8s' % ('', 'ops/s', 'ops/s', '', 'p99 ms', 'p99 ms', '')
+    for name in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[name], candidate[name]
+        throughput = old['ops_per_second'] and new['ops_per_second'] / old['ops_per_second'] - 1 or 0
+        old_p99, new_p99 = old['latency']['p99'] or 0, new['latency']['p99'] or 0
+        latency = old_p99 and new_p99 / old_p99 - 1 or 0
+        flag = ''
+        if throughput < -threshold or latency > threshold or new['errors'] > old['errors']:
+            flag = 'REGRESSED'
+            regressions.append(name)
+        print '%-40s %12.1f %12.1f %+7.1f%% %10.2f %10.2f %+7.1f%% %s' % (
+                name, old['ops_per_second'], new['ops_per_second'], throughput * 100,
+                old_p99 * 1000, new_p99 * 1000, latency * 100, flag)
+    return regressions
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog baseline.json candidate.json')
+    parser.add_option('--threshold', type='float', default=0.1, help='tolerated relative change [%default]')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('need a baseline and a candidate report')
+    regressions = compare(load(args[0]), load(args[1]), options.threshold)
+    if regressions:
+        print '%d benchmarks regressed by more than %d%%' % (len(regressions), options.threshold * 100)
+        sys.exit(1)
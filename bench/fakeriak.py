@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""In-memory stand-in for the parts of the Riak and Luwak HTTP APIs otto uses,
+secondary index range queries included. Like riak on the default bitcask
+backend it rejects index queries unless started with --indexes.
+
+    $ python bench/fakeriak.py 8098
+    $ python bench/fakeriak.py --indexes 8098
+"""
+import sys
+import json
+import time
+import uuid
+import base64
+import urllib
+from optparse import OptionParser
+from email import utils as email_utils
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.web import resource, server
+
+VCLOCK = 'a85hYGBgzGDKBVIcypz/fgaUHjmdwZTImMfKwDLh1Ek+LAA='
+
+class FakeRiak(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, latency = 0, indexes = False):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.indexes = indexes
+        self.buckets = {}
+        self.blobs = {}
+        self.requests = 0
+
+    def render(self, request):
+        self.requests += 1
+        path = [urllib.unquote(part) for part in request.path.strip('/').split('/')]
+        if self.latency:
+            reactor.callLater(self.latency, self._finish, request, path)
+            return server.NOT_DONE_YET
+        return self.dispatch(request, path)
+
+    def _finish(self, request, path):
+        body = self.dispatch(request, path)
+        request.write(body)
+        request.finish()
+
+    def dispatch(self, request, path):
+        if path[0] == 'ping':
+            return 'OK'
+        if path[0] == 'luwak':
+            return self.luwak(request, path[1:])
+        if path[0] == 'buckets' and len(path) == 6 and path[2] == 'index':
+            return self.index_query(request, path[1], path[3], path[4], path[5])
+        if path[0] == 'riak':
+            if len(path) == 1:
+                request.setHeader('Content-Type', 'application/json')
+                return json.dumps({'buckets': sorted(name for name, keys in self.buckets.items() if keys)})
+            if len(path) == 2:
+                request.setHeader('Content-Type', 'application/json')
+                return json.dumps({'props': {'name': path[1]}, 'keys': self.buckets.get(path[1], {}).keys()})
+            return self.riak_object(request, path[1], '/'.join(path[2:]))
+        request.setResponseCode(404)
+        return 'not found'
+
+    def riak_object(self, request, bucket_name, key):
+        bucket = self.buckets.setdefault(bucket_name, {})
+        if request.method in ('PUT', 'POST'):
+            headers = dict((name, value) for name, value in request.requestHeaders.getAllRawHeaders()
+                           if name.lower().startswith('x-riak-meta-') or name.lower().startswith('x-riak-index-'))
+            bucket[key] = (request.content.read(), request.getHeader('content-type') or 'application/octet-stream',
+                           headers, time.time())
+            if request.args.get('returnbody') == ['true']:
+                return self._send(request, bucket[key])
+            request.setResponseCode(204)
+            return ''
+        if key not in bucket:
+            request.setResponseCode(404)
+            return 'not found\n'
+        if request.method == 'DELETE':
+            del bucket[key]
+            request.setResponseCode(204)
+            return ''
+        return self._send(request, bucket[key])
+
+    def _send(self, request, entry):
+        data, content_type, headers, modified = entry
+        request.setHeader('Content-Type', content_type)
+        request.setHeader('X-Riak-Vclock', VCLOCK)
+        request.setHeader('Last-Modified', email_utils.formatdate(modified, usegmt=True))
+        for name, values in headers.items():
+            for value in values:
+                request.responseHeaders.addRawHeader(name, value)
+        return data
+
+    def index_query(self, request, bucket_name, index, start, end):
+        if not self.indexes:
+            request.setResponseCode(500)
+            return '{error,{indexes_not_supported,riak_kv_bitcask_backend}}'
+        header = 'x-riak-index-%s' % index.lower()
+        matches = []
+        for key, (data, content_type, headers, modified) in self.buckets.get(bucket_name, {}).items():
+            if index == '$key' and start <= key <= end:
+                matches.append((key, key))
+            for name, values in headers.items():
+                if name.lower() == header:
+                    for value in values:
+                        matches.extend((term.strip(), key) for term in value.split(',')
+                                       if start <= term.strip() <= end)
+        matches.sort()
+        continuation = request.args.get('continuation', [None])[0]
+        if continuation:
+            after = tuple(json.loads(base64.urlsafe_b64decode(continuation)))
+            matches = [match for match in matches if match > after]
+        result = {}
+        max_results = int(request.args.get('max_results', [0])[0])
+        if max_results and len(matches) > max_results:
+            matches = matches[:max_results]
+            result['continuation'] = base64.urlsafe_b64encode(json.dumps(matches[-1]))
+        if request.args.get('return_terms') == ['true']:
+            result['results'] = [{term: key} for term, key in matches]
+        else:
+            result['keys'] = [key for term, key in matches]
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(result)
+
+    def luwak(self, request, path):
+        files = self.buckets.setdefault('luwak_file', {})
+        if request.method == 'POST' and not path:
+            name = uuid.uuid4().hex
+            self.blobs[name] = request.content.read()
+            files[name] = ('{}', 'application/json', {}, time.time())
+            request.setResponseCode(201)
+            request.setHeader('Location', '/luwak/%s' % name)
+            return ''
+        name = path and path[0]
+        if name not in self.blobs:
+            request.setResponseCode(404)
+            return 'not found\n'
+        if request.method == 'DELETE':
+            del self.blobs[name]
+            files.pop(name, None)
+            request.setResponseCode(204)
+            return ''
+        data = self.blobs[name]
+        request.setHeader('Content-Type', 'application/unknown')
+        byte_range = request.getHeader('range')
+        if byte_range and byte_range.startswith('bytes='):
+            start, _, end = byte_range[6:].partition('-')
+            start = int(start)
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            request.setResponseCode(206)
+            request.setHeader('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+            return data[start:end + 1]
+        return data
+
+def listen(port, latency = 0, interface = '127.0.0.1', indexes = False):
+    riak = FakeRiak(latency, indexes)
+    reactor.listenTCP(port, server.Site(riak), interface=interface)
+    return riak
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [port] [latency]')
+    parser.add_option('--indexes', action='store_true', default=False,
+                      help='answer secondary index queries, like the eleveldb backend')
+    options, args = parser.parse_args()
+    log.startLogging(sys.stdout)
+    listen(int(args[0]) if args else 8098, float(args[1]) if len(args) > 1 else 0, indexes=options.indexes)
+    reactor.run()
@@ -5,35 +5,334 @@ VERSION = tuple(map(int, __version__.split('.')))
 __all__ = ['otto']
 __author__ = 'Juliano Martinez <juliano@martinez.io>'
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces, reactor
+from twisted.protocols import basic
 from twisted.python import log
+from zope.interface import implements
 from cyclone import escape
+from cyclone import httpserver
 from cyclone import web
-from cyclone import redis
+from otto import auth
+from otto import cache
+from otto import metrics
+from otto.storage import BadDigest, InvalidName, valid_bucket_name
 
 import datetime, urllib, sys, os, base64
+import calendar, uuid, urlparse, random
+from xml.etree import ElementTree
+from email import utils as email_utils
 from hashlib import md5
 import functools
 
+CHUNK_SIZE = 65536
+S3_NAMESPACE = "http://doc.s3.amazonaws.com/2006-03-01"
+MAX_DELETE_KEYS = 1000
+
+def parse_range(header, size):
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        spec = spec.strip()
+        if '-' not in spec:
+            return None
+        first, last = spec.split('-', 1)
+        try:
+            if not first:
+                length = int(last)
+                if not length or not size:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+                if start >= size:
+                    continue
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        ranges.append((start, end))
+    return ranges
+
+def parse_part_list(body):
+    try:
+        root = ElementTree.fromstring(body)
+    except SyntaxError:
+        raise web.HTTPError(400, 'Malformed CompleteMultipartUpload document')
+    parts = []
+    for element in root.getiterator():
+        if element.tag.split('}')[-1] != 'Part':
+            continue
+        part = dict((child.tag.split('}')[-1], (child.text or '').strip()) for child in element)
+        try:
+            parts.append((int(part['PartNumber']), part['ETag'].strip('"')))
+        except (KeyError, ValueError):
+            raise web.HTTPError(400, 'Malformed part in CompleteMultipartUpload document')
+    if not parts:
+        raise web.HTTPError(400, 'CompleteMultipartUpload lists no parts')
+    numbers = [part_number for part_number, etag in parts]
+    if numbers != sorted(set(numbers)):
+        raise web.HTTPError(400, 'Parts must be listed in ascending order')
+    return parts
+
+def parse_delete_list(body):
+    try:
+        root = ElementTree.fromstring(body)
+    except SyntaxError:
+        raise web.HTTPError(400, 'Malformed Delete document')
+    quiet = False
+    keys = []
+    for element in root:
+        tag = element.tag.split('}')[-1]
+        if tag == 'Quiet':
+            quiet = (element.text or '').strip().lower() == 'true'
+        elif tag == 'Object':
+            for child in element:
+                if child.tag.split('}')[-1] == 'Key':
+                    keys.append(child.text or '')
+    if not keys:
+        raise web.HTTPError(400, 'Delete document lists no objects')
+    if len(keys) > MAX_DELETE_KEYS:
+        raise web.HTTPError(400, 'Delete document lists more than %d objects' % MAX_DELETE_KEYS)
+    return keys, quiet
+
+def request_length(request):
+    stream = getattr(request, 'body_stream', None)
+    if stream is not None:
+        return stream.length
+    return len(request.body or '')
+
+class RequestBodyStream(object):
+    """The body of a request as it comes off the socket. The connection is
+    paused while more than buffer_size bytes wait to be read."""
+    def __init__(self, transport, length, buffer_size = 4 * CHUNK_SIZE):
+        self.transport = transport
+        self.length = length
+        self.remaining = length
+        self.buffer_size = buffer_size
+        self.buffered = 0
+        self.chunks = []
+        self.paused = False
+        self.discarding = False
+        self.error = None
+        self._waiting = None
+
+    def feed(self, data):
+        self.remaining -= len(data)
+        if not self.discarding:
+            self.chunks.append(data)
+            self.buffered += len(data)
+            if self.buffered > self.buffer_size and not self.paused:
+                self.paused = True
+                self.transport.pauseProducing()
+        self._wakeup()
+
+    def fail(self, reason):
+        self.error = reason
+        self._wakeup()
+
+    def discard(self):
+        """Drops whatever the handler did not read, so the connection can
+        move on to the next request"""
+        self.discarding = True
+        self.chunks = []
+        self.buffered = 0
+        self._resume()
+
+    def _resume(self):
+        if self.paused:
+            self.paused = False
+            self.transport.resumeProducing()
+
+    def _wakeup(self):
+        if self._waiting is not None:
+            d, self._waiting = self._waiting, None
+            d.callback(None)
+
+    @defer.inlineCallbacks
+    def read(self):
+        """Returns the next chunk of the body, '' after the last one"""
+        while not self.chunks:
+            if self.remaining <= 0 or self.discarding:
+                defer.returnValue('')
+            if self.error is not None:
+                raise IOError('Connection lost while reading the request body: %s' % self.error)
+            self._resume()
+            self._waiting = defer.Deferred()
+            yield self._waiting
+        data = self.chunks.pop(0)
+        self.buffered -= len(data)
+        if self.buffered <= self.buffer_size:
+            self._resume()
+        defer.returnValue(data)
+
+class StreamingHTTPConnection(httpserver.HTTPConnection):
+    """Dispatches PUT requests as soon as their headers are in and feeds the
+    body to the handler as it arrives, instead of collecting all of it first."""
+    body_stream = None
+
+    def setRawMode(self):
+        request = self._request
+        if request is None or request.method != 'PUT':
+            return httpserver.HTTPConnection.setRawMode(self)
+        self._contentbuffer = None
+        self.body_stream = request.body_stream = RequestBodyStream(self.transport, self.content_length)
+        request.body = ''
+        basic.LineReceiver.setRawMode(self)
+        self.request_callback(request)
+
+    def rawDataReceived(self, data):
+        stream = self.body_stream
+        if stream is None:
+            return httpserver.HTTPConnection.rawDataReceived(self, data)
+        data, rest = data[:self.content_length], data[self.content_length:]
+        self.content_length -= len(data)
+        if data:
+            stream.feed(data)
+        if self.content_length == 0:
+            self.content_length = self.body_stream = None
+            self.setLineMode(rest)
+
+    def connectionLost(self, reason):
+        # tell the handler first, failing the body may finish it with an error
+        httpserver.HTTPConnection.connectionLost(self, reason)
+        if self.body_stream is not None:
+            self.body_stream.fail(reason.getErrorMessage())
+            self.body_stream = None
+
 class S3Application(web.Application):
-    def __init__(self, storage, storage_config = {}):
+    protocol = StreamingHTTPConnection
+
+    def __init__(self, storage, storage_config = {}, settings = {}, credential_config = {}):
         web.Application.__init__(self, [
+            (r"/_metrics", MetricsHandler),
             (r"/", RootHandler),
             (r"/([^/]+)/(.+)", ObjectHandler),
             (r"/([^/]+)[/]?", BucketHandler),
         ])
         exec("from otto.storage import %s as ObjectStorage" % storage)
-        self.storage = ObjectStorage.ObjectStorage(storage_config)
-        # TODO: split from redis into generic authorization class, expose config settings
-        self.auth_db = redis.lazyConnectionPool() 
+        self.backend = self.storage = ObjectStorage.ObjectStorage(storage_config)
+        self.content_cache = self.metadata_cache = None
+        content_cache_size = int(settings.get('contentcachesize', 0))
+        if content_cache_size > 0:
+            self.storage = self.content_cache = cache.ContentCachedObjectStorage(self.storage, content_cache_size,
+                                                    int(settings.get('contentcachemaxobject', 256 * 1024)),
+                                                    float(settings.get('contentcachettl', 5)))
+        metadata_cache_size = int(settings.get('metadatacachesize', 0))
+        if metadata_cache_size > 0:
+            self.storage = self.metadata_cache = cache.CachedObjectStorage(self.storage, metadata_cache_size,
+                                                     float(settings.get('metadatacachettl', 5)))
+        self.reserved_buckets = frozenset(getattr(self.backend, '_private', ()))
+        self.authenticator = auth.from_config(settings, credential_config)
+        self.log_sample_rate = float(settings.get('requestlogsamplerate', 1))
+        self.log_slow_threshold = float(settings.get('requestlogslowthreshold', 1))
+        self.metrics = None
+        if settings.get('metrics', 'on').lower() in ('on', 'true', 'yes', '1'):
+            self.metrics = metrics.Registry()
+            self.metrics.add_collector(self._storage_gauges)
+            self.storage = metrics.InstrumentedStorage(self.storage, self.metrics, storage)
+            self.reactor_lag = metrics.ReactorLag(self.metrics)
+            reactor.callWhenRunning(self.reactor_lag.start)
+
+    def _storage_gauges(self):
+        gauges = {}
+        for kind, _cache in (('metadata', self.metadata_cache), ('content', self.content_cache)):
+            if _cache is not None:
+                for name, value in _cache.stats().items():
+                    gauges[('otto_%s_cache_%s' % (kind, name), ())] = value
+        if getattr(self.backend, 'threadpool', None) is not None:
+            gauges[('otto_storage_io_pending', ())] = self.backend.io_pending
+        if hasattr(self.backend, 'nodes'):
+            for node, node_stats in self.backend.nodes.stats().items():
+                for name, value in node_stats.items():
+                    gauges[('otto_riak_node_%s' % name, (('node', node),))] = int(value)
+        if hasattr(self.backend, 'gc'):
+            for name, value in self.backend.gc.stats().items():
+                if isinstance(value, (int, long, float)):
+                    gauges[('otto_riak_gc_%s' % name, ())] = value
+        if self.authenticator is not None:
+            for name, value in self.authenticator.store.stats().items():
+                gauges[('otto_credential_cache_%s' % name, ())] = value
+        return gauges
+
+    def log_request(self, handler):
+        status = handler.get_status()
+        request_time = handler.request.request_time()
+        if self.metrics is not None:
+            handler.leave()
+            labels = (('handler', handler.__class__.__name__), ('method', handler.request.method))
+            self.metrics.inc('otto_requests_total', labels + (('status', '%dxx' % (status // 100)),))
+            self.metrics.observe('otto_request_seconds', labels, request_time)
+            self.metrics.inc('otto_received_bytes_total', labels, request_length(handler.request))
+            self.metrics.inc('otto_sent_bytes_total', labels,
+                             int(handler._headers.get('Content-Length', 0)) + handler.bytes_streamed)
+        if status >= 500 or request_time >= self.log_slow_threshold or random.random() < self.log_sample_rate:
+            web.Application.log_request(self, handler)
+
+class TransportThrottle(object):
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._paused = None
+        self.stopped = False
+        transport.registerProducer(self, True)
+
+    def pauseProducing(self):
+        if self._paused is None:
+            self._paused = defer.Deferred()
+
+    def resumeProducing(self):
+        if self._paused is not None:
+            d, self._paused = self._paused, None
+            d.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+    def wait(self):
+        if self._paused is not None:
+            return self._paused
+        return defer.succeed(None)
+
+    def unregister(self):
+        self.transport.unregisterProducer()
 
 class BaseRequestHandler(web.RequestHandler):
+    bytes_streamed = 0
+    in_flight = False
+
+    def prepare(self):
+        if self.application.metrics is not None:
+            self.in_flight = True
+            self.application.metrics.add('otto_requests_in_flight')
+
+    def leave(self):
+        if self.in_flight:
+            self.in_flight = False
+            self.application.metrics.add('otto_requests_in_flight', (), -1)
+
+    def on_finish(self):
+        stream = getattr(self.request, 'body_stream', None)
+        if stream is not None:
+            stream.discard()
+
+    def on_connection_close(self, reason = None):
+        # cyclone fires this from request.finish() too, with no reason and
+        # before _finished is set; only a lost connection passes one
+        if self.application.metrics is not None and reason is not None and not self._finished:
+            self.application.metrics.inc('otto_connections_lost_total', (('handler', self.__class__.__name__),))
+            self.leave()
+
     def render_xml(self, value):
         assert isinstance(value, dict) and len(value) == 1
         self.set_header("Content-Type", "application/xml; charset=UTF-8")
         name = value.keys()[0]
         parts = []
-        parts.append('<%s xmlns="http://doc.s3.amazonaws.com/2006-03-01">' % escape.utf8(name))
+        parts.append('<%s xmlns="%s">' % (escape.utf8(name), S3_NAMESPACE))
         self._render_parts(value.values()[0], parts)
         parts.append('</%s>' % escape.utf8(name))
         self.finish('<?xml version="1.0" encoding="UTF-8"?>\n %s' % ''.join(parts))
@@ -56,52 +355,146 @@ class BaseRequestHandler(web.RequestHandler):
         else:
             raise Exception("Unknown S3 value type %r", value)
     
-    def _calculate_hash(self):
-        pass
+    def _render_contents(self, contents):
+        parts = []
+        for content in contents:
+            parts.append('<Contents><Key>%s</Key>' % escape.xhtml_escape(content['Key']))
+            if 'LastModified' in content:
+                parts.append('<LastModified>%s</LastModified>' % content['LastModified'].strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+            if 'ETag' in content:
+                parts.append('<ETag>%s</ETag>' % escape.xhtml_escape(content['ETag']))
+            if 'Size' in content:
+                parts.append('<Size>%d</Size>' % content['Size'])
+            parts.append('</Contents>')
+        return ''.join(parts)
 
-    def _sign_string(self):
-        pass
-    
-    def _authenticate(self, access_key, signed_string):
-        return True
+    @defer.inlineCallbacks
+    def stream_listing(self, header, iterator):
+        # errors from the first batch still get a proper status
+        contents = yield iterator.next_batch()
+        chunked = self.request.version == "HTTP/1.1"
+        self.set_header("Content-Type", "application/xml; charset=UTF-8")
+        if chunked:
+            self.set_header("Transfer-Encoding", "chunked")
+        else:
+            self.set_header("Connection", "close")
+        self.flush()
+        transport = self.request.connection.transport
+        throttle = TransportThrottle(transport)
+        def send(data):
+            data = escape.utf8(data)
+            self.bytes_streamed += len(data)
+            if chunked:
+                data = '%x\r\n%s\r\n' % (len(data), data)
+            transport.write(data)
+
+        try:
+            parts = ['<?xml version="1.0" encoding="UTF-8"?>\n <ListBucketResult xmlns="%s">' % S3_NAMESPACE]
+            self._render_parts(header, parts)
+            send(''.join(parts))
+            while contents and not throttle.stopped:
+                send(self._render_contents(contents))
+                yield throttle.wait()
+                contents = yield iterator.next_batch()
+            parts = []
+            self._render_parts({'IsTruncated': iterator.truncated and 'true' or 'false'}, parts)
+            if iterator.next_marker is not None:
+                self._render_parts({'NextMarker': iterator.next_marker}, parts)
+            parts.append('</ListBucketResult>')
+            send(''.join(parts))
+            if chunked:
+                transport.write('0\r\n\r\n')
+        except Exception, e:
+            log.msg('Streaming listing aborted: %s' % e)
+            throttle.unregister()
+            transport.loseConnection()
+            return
+        throttle.unregister()
+        self.finish()
+        if not chunked:
+            transport.loseConnection()
+
+    def check_bucket_name(self, bucket_name):
+        if not valid_bucket_name(bucket_name, self.application.reserved_buckets):
+            raise InvalidName('Invalid bucket name %s' % bucket_name)
+
+    def has_query_flag(self, name):
+        return name in urlparse.parse_qs(self.request.query, keep_blank_values=True)
+
+    def content_md5(self):
+        header = self.request.headers.get("Content-MD5")
+        if not header:
+            return None
+        try:
+            return base64.b64decode(header).encode('hex')
+        except TypeError:
+            raise BadDigest('Content-MD5 %s is not valid base64' % header)
+
+    @defer.inlineCallbacks
+    def ingest_body(self, writer, expected_etag = None):
+        stream = getattr(self.request, 'body_stream', None)
+        m = md5()
+        try:
+            if stream is None:
+                body = self.request.body
+                for offset in xrange(0, len(body), CHUNK_SIZE):
+                    chunk = body[offset:offset + CHUNK_SIZE]
+                    m.update(chunk)
+                    yield writer.write(chunk)
+            else:
+                while True:
+                    chunk = yield stream.read()
+                    if not chunk:
+                        break
+                    m.update(chunk)
+                    yield writer.write(chunk)
+                if stream.remaining > 0:
+                    raise IOError('Request body ended %d bytes short' % stream.remaining)
+        except:
+            writer.abort()
+            raise
+        etag = m.hexdigest()
+        if expected_etag is not None and etag != expected_etag:
+            writer.abort()
+            raise BadDigest('Content-MD5 does not match the body')
+        yield writer.close(etag)
+        defer.returnValue(etag)
 
 def Authenticator(method):
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        try:
-            auth_hdr = self.request.headers["Authorization"]
-            if auth_hdr is not None:
-                auth_type, auth_data = auth_hdr.split()
-            assert auth_type == "AWS"
-            access_key, signed_hash = auth_data.split(":", 1)
-            log.msg(self._authenticate(access_key, signed_hash))
-        except Exception, e:
-            log.msg(e)
-            # All arguments are optional. Defaults are:
-            # log_message=None, auth_type="Basic", realm="Restricted Access"
-            raise cyclone.web.HTTPAuthenticationRequired(
-                                log_message="Authentication failed!",
-                                auth_type="AWS", realm="otto")
-        else:
-            #self._current_user = usr
+        authenticator = self.application.authenticator
+        if authenticator is None:
             return method(self, *args, **kwargs)
+        def authenticated(access_key):
+            self._current_user = access_key
+            return method(self, *args, **kwargs)
+        return authenticator.authenticate(self.request).addCallback(authenticated)
     return wrapper
 
+class MetricsHandler(BaseRequestHandler):
+    def get(self):
+        if self.application.metrics is None:
+            raise web.HTTPError(404)
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(self.application.metrics.render())
+
 class RootHandler(BaseRequestHandler):
+    @Authenticator
     @defer.inlineCallbacks
     @web.asynchronous
     def get(self):
-        log.msg('Accessing root directory')
         bucket_list = yield self.application.storage.list_buckets()
         self.render_xml({"ListAllMyBucketsResult": {
             "Buckets": {"Bucket": bucket_list},
         }})
 
 class BucketHandler(BaseRequestHandler):
+    @Authenticator
     @defer.inlineCallbacks
     @web.asynchronous
     def get(self, bucket_name):
-        log.msg('Accessing bucket %s' % bucket_name)
+        self.check_bucket_name(bucket_name)
         prefix = self.get_argument("prefix", u"")
         marker = self.get_argument("marker", u"")
         max_keys = int(self.get_argument("max-keys", 50000))
@@ -109,75 +502,286 @@ class BucketHandler(BaseRequestHandler):
         status = yield self.application.storage.is_bucket(bucket_name)
         if not status:
             raise web.HTTPError(404)
-        _objects = yield self.application.storage.list_objects(bucket_name, marker, prefix, max_keys, terse)
-        self.render_xml({"ListBucketResult": _objects})
+        iterator = self.application.storage.iter_objects(bucket_name, marker, prefix, max_keys, terse)
+        yield self.stream_listing({
+            'Name': bucket_name,
+            'Prefix': prefix,
+            'Marker': marker,
+            'MaxKeys': max_keys,
+        }, iterator)
 
+    @Authenticator
     @defer.inlineCallbacks
     @web.asynchronous
-    @Authenticator
     def put(self, bucket_name):
+        self.check_bucket_name(bucket_name)
         log.msg('Creating bucket %s' % bucket_name)
         status = yield self.application.storage.is_bucket(bucket_name)
         if status:
             raise web.HTTPError(403)
-        self.application.storage.create_bucket(bucket_name)
+        created = yield self.application.storage.create_bucket(bucket_name)
+        if not created:
+            raise web.HTTPError(403)
         self.finish()
 
+    @Authenticator
+    @defer.inlineCallbacks
+    @web.asynchronous
+    def post(self, bucket_name):
+        self.check_bucket_name(bucket_name)
+        if not self.has_query_flag("delete"):
+            raise web.HTTPError(400)
+        expected_etag = self.content_md5()
+        if expected_etag is not None and md5(self.request.body).hexdigest() != expected_etag:
+            raise BadDigest('Content-MD5 does not match the body')
+        object_names, quiet = parse_delete_list(self.request.body)
+        status = yield self.application.storage.is_bucket(bucket_name)
+        if not status:
+            raise web.HTTPError(404)
+        log.msg('Deleting %d objects from bucket %s' % (len(object_names), bucket_name))
+        results = yield self.application.storage.delete_objects(bucket_name, object_names)
+        deleted = []
+        errors = []
+        for object_name, error in results:
+            if error is None:
+                if not quiet:
+                    deleted.append({"Key": object_name})
+            else:
+                errors.append({"Key": object_name, "Code": "InternalError", "Message": error})
+        result = {}
+        if deleted:
+            result["Deleted"] = deleted
+        if errors:
+            result["Error"] = errors
+        self.render_xml({"DeleteResult": result})
+
+    @Authenticator
     @defer.inlineCallbacks
     @web.asynchronous
     def delete(self, bucket_name):
+        self.check_bucket_name(bucket_name)
         log.msg('Deleting bucket %s' % bucket_name)
         status = yield self.application.storage.is_bucket(bucket_name)
         if not status:
             raise web.HTTPError(404)
-        contents = yield self.application.storage.list_objects(bucket_name)
+        contents = yield self.application.storage.list_objects(bucket_name, max_keys=1)
         if len(contents['Contents']) > 0:
             raise web.HTTPError(403)
-        self.application.storage.delete_bucket(bucket_name)
+        deleted = yield self.application.storage.delete_bucket(bucket_name)
+        if not deleted:
+            raise web.HTTPError(404)
         self.set_status(204)
         self.finish()
 
 class ObjectHandler(BaseRequestHandler):
+    @Authenticator
     @defer.inlineCallbacks
     @web.asynchronous
     def get(self, bucket_name, object_name):
-        log.msg('Accessing object %s from bucket %s' % (object_name, bucket_name))
+        self.check_bucket_name(bucket_name)
         object_name = urllib.unquote(object_name)
-        status = yield self.application.storage.is_object(bucket_name, object_name)
-        if not status:
+        upload_id = self.get_argument("uploadId", None)
+        if upload_id is not None:
+            record, parts = yield self.application.storage.list_parts(bucket_name, object_name, upload_id)
+            for part in parts:
+                part['ETag'] = '"%s"' % part['ETag']
+            self.render_xml({"ListPartsResult": {
+                "Bucket": bucket_name,
+                "Key": object_name,
+                "UploadId": upload_id,
+                "Part": parts,
+            }})
+            return
+        _object = yield self.application.storage.open_object(bucket_name, object_name)
+        if _object is None:
             raise web.HTTPError(404)
+        try:
+            yield self._send_object(bucket_name, object_name, _object)
+        finally:
+            _object.close()
+
+    @defer.inlineCallbacks
+    def _send_object(self, bucket_name, object_name, _object):
+        _stat = _object.stat
+        size = _stat['Size']
         self.set_header("Content-Type", "application/unknown")
-        _stat = yield self.application.storage.stat_object(bucket_name, object_name)
         self.set_header("Last-Modified", _stat['LastModified'])
-        _object = yield self.application.storage.read_object(bucket_name, object_name)
-        self.finish(_object)
+        self.set_header("Accept-Ranges", "bytes")
+        if _stat.get('ETag'):
+            self.set_header("ETag", '"%s"' % _stat['ETag'])
+        if self._not_modified(_stat):
+            self.set_status(304)
+            self.finish()
+            return
+
+        ranges = None
+        if self._if_range_matches(_stat):
+            ranges = parse_range(self.request.headers.get("Range"), size)
+        if ranges is not None and not ranges:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            self.finish()
+            return
+
+        transport = self.request.connection.transport
+        try:
+            if ranges is None:
+                self.set_header("Content-Length", size)
+                self.flush()
+                yield _object.stream(transport)
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+                self.set_header("Content-Length", end - start + 1)
+                self.flush()
+                yield _object.stream(transport, start, end - start + 1)
+            else:
+                boundary = uuid.uuid4().hex
+                parts = [('\r\n--%s\r\nContent-Type: application/unknown\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                            (boundary, start, end, size), start, end) for start, end in ranges]
+                trailer = '\r\n--%s--\r\n' % boundary
+                self.set_status(206)
+                self.set_header("Content-Type", "multipart/byteranges; boundary=%s" % boundary)
+                self.set_header("Content-Length",
+                    sum(len(part) + end - start + 1 for part, start, end in parts) + len(trailer))
+                self.flush()
+                for part, start, end in parts:
+                    transport.write(part)
+                    yield _object.stream(transport, start, end - start + 1)
+                transport.write(trailer)
+        except Exception, e:
+            log.msg('Streaming object %s from bucket %s aborted: %s' % (object_name, bucket_name, e))
+            transport.loseConnection()
+            return
+        self.finish()
 
+    def _not_modified(self, _stat):
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            if if_none_match.strip() == '*':
+                return True
+            etags = [etag.strip().lstrip('W/').strip('"') for etag in if_none_match.split(',')]
+            return bool(_stat.get('ETag')) and _stat['ETag'] in etags
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since:
+            since = email_utils.parsedate_tz(if_modified_since)
+            if since is None:
+                return False
+            last_modified = calendar.timegm(_stat['LastModified'].utctimetuple())
+            return last_modified <= email_utils.mktime_tz(since)
+        return False
+
+    def _if_range_matches(self, _stat):
+        if_range = self.request.headers.get("If-Range")
+        if not if_range:
+            return True
+        if if_range.strip().startswith('"') or if_range.strip().startswith('W/'):
+            return bool(_stat.get('ETag')) and if_range.strip().strip('"') == _stat['ETag']
+        since = email_utils.parsedate_tz(if_range)
+        if since is None:
+            return False
+        return calendar.timegm(_stat['LastModified'].utctimetuple()) <= email_utils.mktime_tz(since)
+
+    @Authenticator
     @defer.inlineCallbacks
+    @web.asynchronous
     def put(self, bucket_name, object_name):
-        log.msg('Writing object %s on bucket %s' % (object_name, bucket_name))
+        self.check_bucket_name(bucket_name)
         object_name = urllib.unquote(object_name)
-        body = self.request.body
-        m = md5(body)
-        etag = m.hexdigest()
-        self.set_header("ETag", '"%s"' % etag)
         status = yield self.application.storage.is_bucket(bucket_name)
         if not status:
             raise web.HTTPError(404)
+        upload_id = self.get_argument("uploadId", None)
+        copy_source = self.request.headers.get("x-amz-copy-source")
+        if upload_id is not None:
+            if copy_source is not None:
+                raise web.HTTPError(501, 'Copying into a multipart upload part is not supported')
+            part_number = int(self.get_argument("partNumber"))
+            if not 1 <= part_number <= 10000:
+                raise web.HTTPError(400, 'Part number must be between 1 and 10000')
+            writer = yield self.application.storage.open_part_writer(bucket_name, object_name, upload_id, part_number,
+                                                                     request_length(self.request))
+            etag = yield self.ingest_body(writer, self.content_md5())
+            self.set_header("ETag", '"%s"' % etag)
+            self.finish()
+            return
+
         status = yield self.application.storage.is_bucket(bucket_name, object_name)
         if status:
             raise web.HTTPError(403)
-        self.application.storage.write_object(bucket_name, object_name, body)
+        if copy_source is not None:
+            yield self._copy_object(bucket_name, object_name, copy_source)
+            return
+        content_md5 = self.content_md5()
+        writer = yield self.application.storage.open_object_writer(bucket_name, object_name,
+                                                                   request_length(self.request), content_md5)
+        etag = yield self.ingest_body(writer, content_md5)
+        self.set_header("ETag", '"%s"' % etag)
         self.finish()
 
+    @defer.inlineCallbacks
+    def _copy_object(self, bucket_name, object_name, copy_source):
+        source_bucket, _, source_name = urllib.unquote(copy_source.split('?')[0]).lstrip('/').partition('/')
+        if not source_bucket or not source_name:
+            raise web.HTTPError(400, 'x-amz-copy-source must be bucket/key')
+        self.check_bucket_name(source_bucket)
+        if (source_bucket, source_name) == (bucket_name, object_name):
+            raise web.HTTPError(400, 'An object can not be copied onto itself')
+        _stat = yield self.application.storage.copy_object(source_bucket, source_name, bucket_name, object_name)
+        if not _stat:
+            raise web.HTTPError(404)
+        result = {"LastModified": _stat['LastModified']}
+        if _stat.get('ETag'):
+            result["ETag"] = '"%s"' % _stat['ETag']
+        self.render_xml({"CopyObjectResult": result})
+
+    @Authenticator
+    @defer.inlineCallbacks
+    @web.asynchronous
+    def post(self, bucket_name, object_name):
+        self.check_bucket_name(bucket_name)
+        object_name = urllib.unquote(object_name)
+        upload_id = self.get_argument("uploadId", None)
+        if self.has_query_flag("uploads"):
+            log.msg('Initiating upload of object %s on bucket %s' % (object_name, bucket_name))
+            status = yield self.application.storage.is_bucket(bucket_name)
+            if not status:
+                raise web.HTTPError(404)
+            upload_id = yield self.application.storage.create_multipart_upload(bucket_name, object_name)
+            self.render_xml({"InitiateMultipartUploadResult": {
+                "Bucket": bucket_name,
+                "Key": object_name,
+                "UploadId": upload_id,
+            }})
+        elif upload_id is not None:
+            log.msg('Completing upload %s of object %s on bucket %s' % (upload_id, object_name, bucket_name))
+            parts = parse_part_list(self.request.body)
+            etag = yield self.application.storage.complete_multipart_upload(bucket_name, object_name, upload_id, parts)
+            self.render_xml({"CompleteMultipartUploadResult": {
+                "Location": "/%s/%s" % (bucket_name, urllib.quote(object_name)),
+                "Bucket": bucket_name,
+                "Key": object_name,
+                "ETag": '"%s"' % etag,
+            }})
+        else:
+            raise web.HTTPError(400)
+
+    @Authenticator
     @defer.inlineCallbacks
     @web.asynchronous
     def delete(self, bucket_name, object_name):
-        log.msg('Deleting object %s from bucket %s' % (object_name, bucket_name))
+        self.check_bucket_name(bucket_name)
         object_name = urllib.unquote(object_name)
-        status = yield self.application.storage.is_object(bucket_name, object_name)
+        upload_id = self.get_argument("uploadId", None)
+        if upload_id is not None:
+            yield self.application.storage.abort_multipart_upload(bucket_name, object_name, upload_id)
+            self.set_status(204)
+            self.finish()
+            return
+        status = yield self.application.storage.delete_object(bucket_name, object_name)
         if not status:
             raise web.HTTPError(404)
-        self.application.storage.delete_object(bucket_name, object_name)
         self.set_status(204)
         self.finish()
 
@@ -0,0 +1,175 @@
+import time, hmac, hashlib, base64
+from email import utils as email_utils
+from twisted.python import log
+from twisted.internet import defer
+from cyclone import redis
+from cyclone import web
+from otto import cache
+
+SUBRESOURCES = frozenset([
+    'acl', 'delete', 'lifecycle', 'location', 'logging', 'notification', 'partNumber', 'policy',
+    'requestPayment', 'torrent', 'uploadId', 'uploads', 'versionId', 'versioning', 'versions',
+    'website', 'response-cache-control', 'response-content-disposition',
+    'response-content-encoding', 'response-content-language', 'response-content-type',
+    'response-expires',
+])
+
+class AccessDenied(web.HTTPError):
+    def __init__(self, log_message = 'Access denied'):
+        web.HTTPError.__init__(self, 403, log_message)
+
+class StaticCredentialStore(object):
+    def __init__(self, config = {}):
+        self.credentials = {}
+        for entry in config.get('credentials', '').split(','):
+            if entry.strip():
+                access_key, _, secret = entry.strip().partition(':')
+                self.credentials[access_key] = secret
+        log.msg('StaticCredentialStore loaded with %d keys' % len(self.credentials))
+
+    def get_secret(self, access_key):
+        return defer.succeed(self.credentials.get(access_key))
+
+class RedisCredentialStore(object):
+    def __init__(self, config = {}):
+        self.prefix = config.get('prefix', 'otto:credentials:')
+        self.db = redis.lazyConnectionPool(config.get('host', 'localhost'), int(config.get('port', 6379)),
+                                           poolsize=int(config.get('poolsize', 10)))
+        log.msg('RedisCredentialStore loaded')
+
+    def get_secret(self, access_key):
+        return self.db.get(self.prefix + access_key)
+
+class CachedCredentialStore(object):
+    """Keeps a prepared HMAC per access key so a warm lookup never leaves the process."""
+    def __init__(self, store, size = 10000, ttl = 60, negative_ttl = 5):
+        self.store = store
+        self.negative_ttl = negative_ttl
+        self.cache = cache.LRUCache(size, ttl)
+        self._pending = {}
+
+    def get_signer(self, access_key):
+        signer = self.cache.get(access_key)
+        if signer is not cache._missing:
+            return defer.succeed(signer)
+        if access_key in self._pending:
+            d = defer.Deferred()
+            self._pending[access_key].append(d)
+            return d
+        self._pending[access_key] = []
+        d = defer.maybeDeferred(self.store.get_secret, access_key)
+        d.addCallbacks(self._resolved, self._failed, callbackArgs=(access_key,), errbackArgs=(access_key,))
+        return d
+
+    def _resolved(self, secret, access_key):
+        if secret:
+            signer = hmac.new(secret.encode('utf-8') if isinstance(secret, unicode) else secret,
+                              digestmod=hashlib.sha1)
+            self.cache.set(access_key, signer)
+        else:
+            signer = None
+            self.cache.set(access_key, None, self.negative_ttl)
+        for d in self._pending.pop(access_key, []):
+            d.callback(signer)
+        return signer
+
+    def _failed(self, failure, access_key):
+        for d in self._pending.pop(access_key, []):
+            d.errback(failure)
+        return failure
+
+    def invalidate(self, access_key):
+        self.cache.invalidate(access_key)
+
+    def stats(self):
+        return self.cache.stats()
+
+def canonical_resource(request):
+    resource = request.path
+    subresources = []
+    for name in sorted(request.arguments):
+        if name in SUBRESOURCES:
+            value = request.arguments[name][-1]
+            subresources.append(value and '%s=%s' % (name, value) or name)
+    if subresources:
+        resource += '?' + '&'.join(subresources)
+    return resource
+
+def string_to_sign(request, expires = None):
+    headers = request.headers
+    amz_headers = {}
+    for name, value in headers.get_all():
+        name = name.lower()
+        if name.startswith('x-amz-'):
+            amz_headers.setdefault(name, []).append(value.strip())
+    if expires is not None:
+        date = expires
+    elif 'x-amz-date' in amz_headers:
+        date = ''
+    else:
+        date = headers.get('Date', '')
+    parts = [request.method, headers.get('Content-MD5', ''), headers.get('Content-Type', ''), date]
+    for name in sorted(amz_headers):
+        parts.append('%s:%s' % (name, ','.join(amz_headers[name])))
+    parts.append(canonical_resource(request))
+    return '\n'.join(parts)
+
+def sign(signer, data):
+    signer = signer.copy()
+    signer.update(data)
+    return base64.b64encode(signer.digest())
+
+class Authenticator(object):
+    def __init__(self, store, max_skew = 900):
+        self.store = store
+        self.max_skew = max_skew
+
+    def _credentials(self, request):
+        auth_hdr = request.headers.get('Authorization')
+        if auth_hdr is not None:
+            try:
+                auth_type, auth_data = auth_hdr.split()
+                access_key, signature = auth_data.split(':', 1)
+            except ValueError:
+                raise AccessDenied('Malformed Authorization header')
+            if auth_type != 'AWS':
+                raise AccessDenied('Unsupported authorization type %s' % auth_type)
+            date = request.headers.get('x-amz-date') or request.headers.get('Date')
+            timestamp = date and email_utils.parsedate_tz(date)
+            if not timestamp:
+                raise AccessDenied('Request is missing a valid Date')
+            if abs(time.time() - email_utils.mktime_tz(timestamp)) > self.max_skew:
+                raise AccessDenied('Request time too skewed')
+            return access_key, signature, None
+        if 'Signature' in request.arguments:
+            try:
+                expires = request.arguments['Expires'][-1]
+                if int(expires) < time.time():
+                    raise AccessDenied('Request has expired')
+                return request.arguments['AWSAccessKeyId'][-1], request.arguments['Signature'][-1], expires
+            except (KeyError, ValueError):
+                raise AccessDenied('Malformed query string authentication')
+        raise web.HTTPAuthenticationRequired(log_message='Authentication required',
+                                             auth_type='AWS', realm='otto')
+
+    @defer.inlineCallbacks
+    def authenticate(self, request):
+        access_key, signature, expires = self._credentials(request)
+        signer = yield self.store.get_signer(access_key)
+        if signer is None:
+            raise AccessDenied('Unknown access key %s' % access_key)
+        expected = sign(signer, string_to_sign(request, expires))
+        if not hmac.compare_digest(expected, str(signature)):
+            raise AccessDenied('Signature does not match')
+        defer.returnValue(access_key)
+
+def from_config(settings, credential_config = {}):
+    if settings.get('authentication', 'off').lower() not in ('on', 'true', 'yes', '1'):
+        return None
+    store_name = settings.get('credentialstore', 'StaticCredentialStore')
+    store = CachedCredentialStore(globals()[store_name](credential_config),
+                                  int(settings.get('credentialcachesize', 10000)),
+                                  float(settings.get('credentialcachettl', 60)),
+                                  float(settings.get('credentialnegativettl', 5)))
+    log.msg('Request authentication enabled using %s' % store_name)
+    return Authenticator(store, int(settings.get('maxclockskew', 900)))
@@ -0,0 +1,380 @@
+import time
+from collections import OrderedDict
+from twisted.python import log
+from twisted.internet import defer, interfaces
+from zope.interface import implements
+
+_missing = object()
+
+class LRUCache(object):
+    def __init__(self, size = 10000, ttl = 5):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.pop(key, _missing)
+        if entry is _missing or entry[0] < time.time():
+            self.misses += 1
+            return _missing
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl = None):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def invalidate_if(self, predicate):
+        for key in [key for key in self._entries if predicate(key)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+                    'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions
+               }
+
+class InvalidatingWriter(object):
+    def __init__(self, writer, invalidate):
+        self.writer = writer
+        self.invalidate = invalidate
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    @defer.inlineCallbacks
+    def close(self, *args, **kwargs):
+        try:
+            result = yield self.writer.close(*args, **kwargs)
+        finally:
+            self.invalidate()
+        defer.returnValue(result)
+
+class InvalidatingStorage(object):
+    """Base for storage wrappers that keep state about objects, calls
+    _invalidate_object and _invalidate_bucket around every write."""
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _invalidate_object(self, bucket_name, object_name):
+        pass
+
+    def _invalidate_bucket(self, bucket_name):
+        pass
+
+    @defer.inlineCallbacks
+    def open_object_writer(self, bucket_name, object_name, *args, **kwargs):
+        writer = yield self.storage.open_object_writer(bucket_name, object_name, *args, **kwargs)
+        defer.returnValue(InvalidatingWriter(writer, lambda: self._invalidate_object(bucket_name, object_name)))
+
+    @defer.inlineCallbacks
+    def write_object(self, bucket_name, object_name, *args, **kwargs):
+        try:
+            result = yield self.storage.write_object(bucket_name, object_name, *args, **kwargs)
+        finally:
+            self._invalidate_object(bucket_name, object_name)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def complete_multipart_upload(self, bucket_name, object_name, *args, **kwargs):
+        try:
+            result = yield self.storage.complete_multipart_upload(bucket_name, object_name, *args, **kwargs)
+        finally:
+            self._invalidate_object(bucket_name, object_name)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def copy_object(self, source_bucket, source_name, bucket_name, object_name):
+        try:
+            result = yield self.storage.copy_object(source_bucket, source_name, bucket_name, object_name)
+        finally:
+            self._invalidate_object(bucket_name, object_name)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def delete_object(self, bucket_name, object_name):
+        try:
+            result = yield self.storage.delete_object(bucket_name, object_name)
+        finally:
+            self._invalidate_object(bucket_name, object_name)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def delete_objects(self, bucket_name, object_names):
+        try:
+            result = yield self.storage.delete_objects(bucket_name, object_names)
+        finally:
+            for object_name in object_names:
+                self._invalidate_object(bucket_name, object_name)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def create_bucket(self, bucket_name):
+        try:
+            result = yield self.storage.create_bucket(bucket_name)
+        finally:
+            self._invalidate_bucket(bucket_name)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def delete_bucket(self, bucket_name):
+        try:
+            result = yield self.storage.delete_bucket(bucket_name)
+        finally:
+            self._invalidate_bucket(bucket_name)
+        defer.returnValue(result)
+
+class CachedObjectStorage(InvalidatingStorage):
+    def __init__(self, storage, size = 10000, ttl = 5):
+        log.msg('Metadata cache enabled with %d entries and %ss ttl' % (size, ttl))
+        InvalidatingStorage.__init__(self, storage)
+        self.cache = LRUCache(size, ttl)
+
+    @defer.inlineCallbacks
+    def _cached(self, key, method, *args):
+        result = self.cache.get(key)
+        if result is _missing:
+            result = yield method(*args)
+            self.cache.set(key, result)
+        defer.returnValue(result)
+
+    def _invalidate_object(self, bucket_name, object_name):
+        self.cache.invalidate(('is_object', bucket_name, object_name))
+        self.cache.invalidate(('stat_object', bucket_name, object_name))
+        self.cache.invalidate(('is_bucket', bucket_name, object_name))
+
+    def _invalidate_bucket(self, bucket_name):
+        self.cache.invalidate_if(lambda key: key[1] == bucket_name)
+
+    def is_bucket(self, bucket_name, object_name = None):
+        return self._cached(('is_bucket', bucket_name, object_name), self.storage.is_bucket, bucket_name, object_name)
+
+    def is_object(self, bucket_name, object_name):
+        return self._cached(('is_object', bucket_name, object_name), self._is_object, bucket_name, object_name)
+
+    @defer.inlineCallbacks
+    def _is_object(self, bucket_name, object_name):
+        result = yield self.storage.is_object(bucket_name, object_name)
+        defer.returnValue(bool(result))
+
+    def stat_object(self, bucket_name, object_name):
+        return self._cached(('stat_object', bucket_name, object_name), self.storage.stat_object, bucket_name, object_name)
+
+    def stats(self):
+        return self.cache.stats()
+
+class BufferConsumer(object):
+    """Collects whatever an object handle streams into memory."""
+    implements(interfaces.IConsumer)
+
+    def __init__(self):
+        self.chunks = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        if not streaming:
+            while self.producer is not None:
+                producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+class MemoryHandle(object):
+    def __init__(self, data, stat):
+        self.data = data
+        self.stat = stat
+
+    def stream(self, consumer, offset = 0, length = None):
+        if length is None:
+            length = len(self.data) - offset
+        if offset == 0 and length >= len(self.data):
+            consumer.write(self.data)
+        elif length > 0:
+            consumer.write(self.data[offset:offset + length])
+        return defer.succeed(True)
+
+    def close(self):
+        pass
+
+def _version(stat):
+    return stat.get('ETag'), stat.get('LastModified'), stat.get('Size')
+
+class ContentCache(object):
+    """Object bodies kept in memory within a byte budget, least recently used
+    out first. Only objects up to max_object bytes that were asked for twice
+    within the last admission_window distinct misses are admitted, so a scan
+    over a bucket does not flush the hot set."""
+    def __init__(self, size = 64 * 1024 * 1024, max_object = 256 * 1024, ttl = 5, admission_window = 10000):
+        self.size = size
+        self.max_object = max_object
+        self.ttl = ttl
+        self.admission_window = admission_window
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.admissions = 0
+        self.rejections = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._seen = OrderedDict()
+        self._filling = {}
+
+    def get(self, key):
+        """Returns (data, stat, fresh) or None, stale entries need revalidating"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._entries[key] = entry
+        return entry[1], entry[2], entry[0] >= time.time()
+
+    def refresh(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries[key] = (time.time() + self.ttl,) + entry[1:]
+
+    def admit(self, key, size):
+        if size > self.max_object or size > self.size:
+            self.rejections += 1
+            return False
+        if self._seen.pop(key, None) is None:
+            self._seen[key] = True
+            while len(self._seen) > self.admission_window:
+                self._seen.popitem(last=False)
+            return False
+        return True
+
+    def begin_fill(self, key):
+        token = self._filling[key] = object()
+        return token
+
+    def abandon_fill(self, key, token):
+        if self._filling.get(key) is token:
+            del self._filling[key]
+
+    def fill(self, key, token, data, stat):
+        # a write that raced with the read invalidated the key and took the token
+        if self._filling.get(key) is not token:
+            return
+        del self._filling[key]
+        self.set(key, data, stat)
+
+    def set(self, key, data, stat):
+        self.invalidate(key)
+        self._entries[key] = (time.time() + self.ttl, data, stat)
+        self.bytes += len(data)
+        self.admissions += 1
+        while self.bytes > self.size:
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= len(entry[1])
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._filling.pop(key, None)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+    def invalidate_if(self, predicate):
+        for key in [key for key in self._entries if predicate(key)] + [key for key in self._filling if predicate(key)]:
+            self.invalidate(key)
+
+    def stats(self):
+        return {
+                    'size': len(self._entries),
+                    'bytes': self.bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'revalidations': self.revalidations,
+                    'admissions': self.admissions,
+                    'rejections': self.rejections,
+                    'evictions': self.evictions
+               }
+
+class ContentCachedObjectStorage(InvalidatingStorage):
+    """Serves open_object for small hot objects from memory.
+
+    Writes through this process drop the entry right away; entries older than
+    ttl are checked against stat_object, which catches writes made by other
+    workers, before they are served again.
+    """
+    def __init__(self, storage, size = 64 * 1024 * 1024, max_object = 256 * 1024, ttl = 5):
+        log.msg('Content cache enabled with %d bytes, objects up to %d bytes and %ss ttl' % (size, max_object, ttl))
+        InvalidatingStorage.__init__(self, storage)
+        self.cache = ContentCache(size, max_object, ttl)
+
+    def _invalidate_object(self, bucket_name, object_name):
+        self.cache.invalidate((bucket_name, object_name))
+
+    def _invalidate_bucket(self, bucket_name):
+        self.cache.invalidate_if(lambda key: key[0] == bucket_name)
+
+    @defer.inlineCallbacks
+    def open_object(self, bucket_name, object_name):
+        key = (bucket_name, object_name)
+        cached = self.cache.get(key)
+        if cached is not None:
+            data, stat, fresh = cached
+            if not fresh:
+                self.cache.revalidations += 1
+                try:
+                    current = yield self.storage.stat_object(bucket_name, object_name)
+                except Exception:
+                    # gone, Fs and Dedup raise for missing keys; open_object tells
+                    current = None
+                if current and _version(current) == _version(stat):
+                    self.cache.refresh(key)
+                    fresh = True
+                else:
+                    self.cache.invalidate(key)
+            if fresh:
+                self.cache.hits += 1
+                defer.returnValue(MemoryHandle(data, stat))
+        self.cache.misses += 1
+        token = self.cache.begin_fill(key)
+        handle = yield self.storage.open_object(bucket_name, object_name)
+        if handle is None or not self.cache.admit(key, handle.stat['Size']):
+            self.cache.abandon_fill(key, token)
+            defer.returnValue(handle)
+        consumer = BufferConsumer()
+        try:
+            yield handle.stream(consumer)
+        except:
+            self.cache.abandon_fill(key, token)
+            raise
+        finally:
+            handle.close()
+        data = consumer.getvalue()
+        if len(data) == handle.stat['Size']:
+            self.cache.fill(key, token, data, handle.stat)
+        else:
+            self.cache.abandon_fill(key, token)
+        defer.returnValue(MemoryHandle(data, handle.stat))
+
+    def stats(self):
+        return self.cache.stats()
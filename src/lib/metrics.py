@@ -0,0 +1,136 @@
+import time
+import bisect
+from twisted.internet import defer, task
+from twisted.python import failure
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _labels(labels, extra = ()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+class Registry(object):
+    """Counters, gauges and histograms keyed by (name, labels) rendered in the
+    Prometheus text format. Updates are dict operations, cheap enough for the
+    request path."""
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, labels = (), value = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels = (), value = 0):
+        self.gauges[(name, labels)] = value
+
+    def add(self, name, labels = (), value = 1):
+        key = (name, labels)
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def add_collector(self, collector):
+        """collector() returns {(name, labels): value} gauges sampled at scrape time"""
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        gauges = dict(self.gauges)
+        for collector in self.collectors:
+            try:
+                gauges.update(collector())
+            except Exception, e:
+                lines.append('# collector %s failed: %s' % (collector.__name__, e))
+        for metrics, kind in ((self.counters, 'counter'), (gauges, 'gauge')):
+            seen = set()
+            for (name, labels), value in sorted(metrics.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append('# TYPE %s %s' % (name, kind))
+                lines.append('%s%s %s' % (name, _labels(labels), value))
+        seen = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, (('le', bound),)), cumulative))
+            lines.append('%s_sum%s %f' % (name, _labels(labels), histogram.sum))
+            lines.append('%s_count%s %d' % (name, _labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+class InstrumentedStorage(object):
+    """Times every public storage call, Deferred or not, by backend and operation."""
+    def __init__(self, storage, registry, backend):
+        self.storage = storage
+        self.registry = registry
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        labels = (('backend', self.backend), ('operation', name))
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except:
+                self._record(None, labels, started, True)
+                raise
+            if isinstance(result, defer.Deferred):
+                return result.addBoth(self._record, labels, started)
+            self._record(None, labels, started)
+            return result
+        self.__dict__[name] = timed
+        return timed
+
+    def _record(self, result, labels, started, failed = False):
+        self.registry.observe('otto_storage_seconds', labels, time.time() - started)
+        if failed or isinstance(result, failure.Failure):
+            self.registry.inc('otto_storage_errors_total', labels)
+        return result
+
+class ReactorLag(object):
+    def __init__(self, registry, interval = 0.5):
+        self.registry = registry
+        self.interval = interval
+        self.expected = None
+        self.monitor = task.LoopingCall(self.tick)
+
+    def start(self):
+        self.expected = time.time() + self.interval
+        self.monitor.start(self.interval, now=False)
+
+    def tick(self):
+        now = time.time()
+        lag = max(now - self.expected, 0)
+        self.expected = now + self.interval
+        self.registry.observe('otto_reactor_lag_seconds', (), lag)
+        self.registry.set('otto_reactor_last_lag_seconds', (), lag)
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import ConfigParser
+import otto
+from twisted.application import service
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols import policies
+from twisted.python import log
+
+LISTEN_FD = 3
+HEARTBEAT_FD = 4
+
+def load_config(config_file):
+    config = ConfigParser.RawConfigParser()
+    config.read(config_file)
+    settings = dict(config.items('otto'))
+    storage = config.get('otto', 'ObjectStorage')
+    storage_config = {}
+    if config.has_section(storage):
+        storage_config.update(config.items(storage))
+    credential_config = {}
+    credential_store = settings.get('credentialstore', 'StaticCredentialStore')
+    if config.has_section(credential_store):
+        credential_config.update(config.items(credential_store))
+    return settings, storage, storage_config, credential_config
+
+def build_application(config_file, worker_id = 0):
+    settings, storage, storage_config, credential_config = load_config(config_file)
+    if worker_id:
+        # background sweeps such as the riak garbage collector only run on the first worker
+        storage_config.update({'gc_interval': '0', 'gc_orphan_interval': '0'})
+    return otto.S3Application(storage, storage_config, settings, credential_config)
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, master, worker_id, generation):
+        self.master = master
+        self.worker_id = worker_id
+        self.generation = generation
+        self.started = time.time()
+        self.last_heartbeat = self.started
+        self.pid = None
+        self.status = {}
+        self.retiring = False
+        self.ready = defer.Deferred()
+        self.exited = defer.Deferred()
+        self._buffers = {}
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+
+    def childDataReceived(self, childFD, data):
+        lines = (self._buffers.get(childFD, '') + data).split('\n')
+        self._buffers[childFD] = lines.pop()
+        for line in lines:
+            if childFD == HEARTBEAT_FD:
+                self.heartbeat(line)
+            elif line.strip():
+                log.msg('[worker %d/%s] %s' % (self.worker_id, self.pid, line.rstrip()))
+
+    def heartbeat(self, line):
+        self.last_heartbeat = time.time()
+        try:
+            self.status = json.loads(line)
+        except ValueError:
+            pass
+        if not self.ready.called:
+            self.ready.callback(self)
+
+    def signal(self, signal_name):
+        try:
+            self.transport.signalProcess(signal_name)
+        except Exception:
+            pass
+
+    def processEnded(self, reason):
+        log.msg('Worker %d (pid %s) exited: %s' % (self.worker_id, self.pid, reason.getErrorMessage()))
+        self.exited.callback(self)
+        self.master.worker_exited(self)
+
+class PreforkService(service.Service):
+    """Runs Workers copies of the server on one shared listening socket.
+
+    SIGHUP starts a fresh generation of workers, which re-read the config and
+    code, and retires the old one once the new workers report in. Workers that
+    miss heartbeats for HeartbeatTimeout seconds are killed and respawned.
+    """
+    def __init__(self, config_file, port, settings = {}):
+        self.config_file = os.path.abspath(config_file)
+        self.port = port
+        self.workers = int(settings.get('workers', 1))
+        self.backlog = int(settings.get('listenbacklog', 1024))
+        self.heartbeat_interval = float(settings.get('heartbeatinterval', 1))
+        self.heartbeat_timeout = float(settings.get('heartbeattimeout', 10))
+        self.drain_timeout = float(settings.get('draintimeout', 30))
+        self.generation = 0
+        self.processes = {}
+        self.socket = None
+        self.stopping = False
+        self.health_check = task.LoopingCall(self.check_health)
+
+    def startService(self):
+        service.Service.startService(self)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('', self.port))
+        self.socket.listen(self.backlog)
+        self.socket.setblocking(False)
+        log.msg('Listening on port %d with %d workers' % (self.port, self.workers))
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        self.health_check.start(self.heartbeat_interval, now=False)
+        signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(self.reload))
+
+    def spawn(self, worker_id):
+        worker = WorkerProcess(self, worker_id, self.generation)
+        env = dict(os.environ)
+        src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [src, env.get('PYTHONPATH')]))
+        reactor.spawnProcess(worker, sys.executable,
+                             [sys.executable, '-m', 'otto.prefork', self.config_file, str(worker_id),
+                              str(self.heartbeat_interval), str(self.drain_timeout)],
+                             env=env, path=os.getcwd(),
+                             childFDs={0: 'w', 1: 'r', 2: 'r', LISTEN_FD: self.socket.fileno(), HEARTBEAT_FD: 'r'})
+        self.processes[worker.pid] = worker
+        log.msg('Spawned worker %d generation %d (pid %s)' % (worker_id, self.generation, worker.pid))
+        return worker
+
+    def worker_exited(self, worker):
+        self.processes.pop(worker.pid, None)
+        if self.stopping or worker.retiring or worker.generation != self.generation:
+            return
+        # do not spin when a worker dies during startup, e.g. a broken config
+        delay = time.time() - worker.started < 5 and 5 or 0
+        reactor.callLater(delay, self._respawn, worker.worker_id, worker.generation)
+
+    def _respawn(self, worker_id, generation):
+        if not self.stopping and generation == self.generation:
+            self.spawn(worker_id)
+
+    def check_health(self):
+        now = time.time()
+        for worker in self.processes.values():
+            if not worker.retiring and now - worker.last_heartbeat > self.heartbeat_timeout:
+                log.msg('Worker %d (pid %s) missed heartbeats for %.1fs, killing it' % (
+                        worker.worker_id, worker.pid, now - worker.last_heartbeat))
+                worker.signal('KILL')
+
+    def retire(self, workers):
+        for worker in workers:
+            worker.retiring = True
+            worker.signal('TERM')
+        for worker in workers:
+            reactor.callLater(self.drain_timeout + 5, lambda worker=worker: worker.exited.called or worker.signal('KILL'))
+        return defer.DeferredList([worker.exited for worker in workers])
+
+    @defer.inlineCallbacks
+    def reload(self):
+        log.msg('Reloading workers')
+        old = self.processes.values()
+        self.generation += 1
+        new = [self.spawn(worker_id) for worker_id in range(self.workers)]
+        ready = defer.Deferred()
+        defer.DeferredList([worker.ready for worker in new]).addCallback(lambda _: ready.called or ready.callback(None))
+        timeout = reactor.callLater(self.heartbeat_timeout, lambda: ready.called or ready.callback(None))
+        yield ready
+        if timeout.active():
+            timeout.cancel()
+        yield self.retire(old)
+        log.msg('Reload finished, generation %d serving' % self.generation)
+
+    def stats(self):
+        return dict((worker.pid, dict(worker.status,
+                                      worker=worker.worker_id,
+                                      generation=worker.generation,
+                                      heartbeat_age=time.time() - worker.last_heartbeat))
+                    for worker in self.processes.values())
+
+    def stopService(self):
+        service.Service.stopService(self)
+        self.stopping = True
+        if self.health_check.running:
+            self.health_check.stop()
+        d = self.retire(self.processes.values())
+        d.addBoth(lambda _: self.socket.close())
+        return d
+
+class Worker(object):
+    def __init__(self, application, heartbeat_interval = 1, drain_timeout = 30):
+        self.factory = policies.WrappingFactory(application)
+        self.heartbeat_interval = heartbeat_interval
+        self.drain_timeout = drain_timeout
+        self.heartbeat_pipe = os.fdopen(HEARTBEAT_FD, 'w', 0)
+        self.port = None
+        self.requests = 0
+        self.draining = None
+        self.last_beat = None
+        self.heartbeat = task.LoopingCall(self.beat)
+        self.drain_check = task.LoopingCall(self._check_drained)
+
+    def start(self):
+        self.port = reactor.adoptStreamPort(LISTEN_FD, socket.AF_INET, self.factory)
+        signal.signal(signal.SIGTERM, lambda signum, frame: reactor.callFromThread(self.drain))
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.heartbeat.start(self.heartbeat_interval)
+
+    def beat(self):
+        now = time.time()
+        # a late heartbeat means something held the reactor
+        lag = self.last_beat and max(now - self.last_beat - self.heartbeat_interval, 0) or 0
+        self.last_beat = now
+        try:
+            self.heartbeat_pipe.write(json.dumps({
+                                                    'pid': os.getpid(),
+                                                    'connections': len(self.factory.protocols),
+                                                    'lag': lag,
+                                                    'draining': self.draining is not None
+                                                 }) + '\n')
+        except IOError:
+            log.msg('Lost the master process, shutting down')
+            self.drain()
+
+    def drain(self):
+        if self.draining is not None:
+            return
+        log.msg('Draining %d connections' % len(self.factory.protocols))
+        self.draining = time.time()
+        self.port.stopListening()
+        self.drain_check.start(0.1)
+
+    def _check_drained(self):
+        if not self.factory.protocols or time.time() - self.draining > self.drain_timeout:
+            self.drain_check.stop()
+            self.heartbeat.stop()
+            reactor.stop()
+
+def run_worker(config_file, worker_id, heartbeat_interval = 1, drain_timeout = 30):
+    log.startLogging(sys.stdout)
+    worker = Worker(build_application(config_file, worker_id), heartbeat_interval, drain_timeout)
+    reactor.callWhenRunning(worker.start)
+    reactor.run()
+
+if __name__ == '__main__':
+    run_worker(sys.argv[1], int(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4]))
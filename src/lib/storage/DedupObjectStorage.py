@@ -0,0 +1,391 @@
+import os
+import time
+import fcntl
+import sqlite3
+import datetime
+import tempfile
+import threading
+from hashlib import md5, sha256
+from twisted.python import log
+from twisted.internet import defer
+from otto.storage import BadDigest, BucketNotEmpty
+from otto.storage import FsObjectStorage
+from otto.storage.FsObjectStorage import ObjectWriter, ObjectHandle, _unicode
+
+class CatalogLock(object):
+    """A reentrant thread lock that also holds an flock on path, so worker
+    processes sharing the catalog take turns as well. Reference counts are
+    read, changed and acted on (blobs unlinked) under it."""
+    def __init__(self, path):
+        self._lock = threading.RLock()
+        self._file = open(path, 'a')
+        self._depth = 0
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            except:
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._lock.release()
+
+def _file_digest(path):
+    digest = sha256()
+    with open(path, 'rb') as _file:
+        for chunk in iter(lambda: _file.read(1 << 20), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Catalog(object):
+    """Objects point at blobs named by the SHA-256 of their body; the MD5 is
+    only kept as the ETag, it is too easy to collide to name content by."""
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = CatalogLock('%s.lock' % path)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, created REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, etag TEXT, size INTEGER, '
+                        'mtime REAL, created REAL, blob TEXT, PRIMARY KEY (bucket, key))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, etag TEXT, size INTEGER, refs INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS blobs_etag ON blobs (etag, size)')
+
+    def is_bucket(self, bucket_name):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM buckets WHERE name = ?', (_unicode(bucket_name),)).fetchone() is not None
+
+    def list_buckets(self):
+        with self.lock:
+            return self.db.execute('SELECT name, created FROM buckets ORDER BY name').fetchall()
+
+    def create_bucket(self, bucket_name):
+        with self.lock:
+            return self.db.execute('INSERT OR IGNORE INTO buckets VALUES (?, ?)',
+                                   (_unicode(bucket_name), time.time())).rowcount == 1
+
+    def delete_bucket(self, bucket_name):
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM objects WHERE bucket = ? LIMIT 1', (_unicode(bucket_name),)).fetchone():
+                raise BucketNotEmpty(bucket_name)
+            return self.db.execute('DELETE FROM buckets WHERE name = ?', (_unicode(bucket_name),)).rowcount == 1
+
+    def get(self, bucket_name, object_name):
+        with self.lock:
+            return self.db.execute('SELECT key, size, mtime, etag, created, blob FROM objects WHERE bucket = ? AND key = ?',
+                                   (_unicode(bucket_name), _unicode(object_name))).fetchone()
+
+    def page(self, bucket_name, marker = None, prefix = None, max_keys = 5000):
+        query = 'SELECT key, size, mtime, etag FROM objects WHERE bucket = ? AND key >= ?'
+        args = [_unicode(bucket_name), _unicode(prefix or u'')]
+        if marker:
+            query += ' AND key > ?'
+            args.append(_unicode(marker))
+        query += ' ORDER BY key LIMIT ?'
+        args.append(max_keys + 1)
+        prefix = _unicode(prefix or u'').encode('utf-8')
+        rows = []
+        with self.lock:
+            for row in self.db.execute(query, args):
+                if not row[0].startswith(prefix):
+                    break
+                rows.append(row)
+        return rows[:max_keys], len(rows) > max_keys
+
+    def pin(self, etag, size):
+        """References a blob with this MD5 and size, returns its digest or None."""
+        with self.lock:
+            row = self.db.execute('SELECT digest FROM blobs WHERE etag = ? AND size = ? LIMIT 1', (etag, size)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ?', (row[0],))
+            return row[0]
+
+    def release(self, digest):
+        with self.lock:
+            self.db.execute('UPDATE blobs SET refs = refs - 1 WHERE digest = ?', (digest,))
+            row = self.db.execute('SELECT refs FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if row is not None and row[0] <= 0:
+                self.db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+                return True
+            return False
+
+    def link(self, bucket_name, object_name, digest, etag, size, pinned = False):
+        """Points bucket/key at the blob, returns the digest of a blob that lost its last reference."""
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                old = self.get(bucket_name, object_name)
+                self.db.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, 0)', (digest, etag, size))
+                if not pinned:
+                    self.db.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ?', (digest,))
+                self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (_unicode(bucket_name), _unicode(object_name), etag, size, now,
+                                 old and old[4] or now, digest))
+                orphan = None
+                if old is not None and self.release(old[5]):
+                    orphan = old[5]
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        return orphan
+
+    def unlink(self, bucket_name, object_name):
+        """Returns (found, digest of a blob that lost its last reference)."""
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                old = self.get(bucket_name, object_name)
+                orphan = None
+                if old is not None:
+                    self.db.execute('DELETE FROM objects WHERE bucket = ? AND key = ?',
+                                    (_unicode(bucket_name), _unicode(object_name)))
+                    if self.release(old[5]):
+                        orphan = old[5]
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        return old is not None, orphan
+
+class BucketView(object):
+    def __init__(self, catalog, bucket_name):
+        self.catalog = catalog
+        self.bucket_name = bucket_name
+
+    def is_complete(self):
+        return True
+
+    def get(self, object_name):
+        return self.catalog.get(self.bucket_name, object_name)
+
+    def page(self, marker = None, prefix = None, max_keys = 5000):
+        return self.catalog.page(self.bucket_name, marker, prefix, max_keys)
+
+class DedupWriter(ObjectWriter):
+    def __init__(self, storage, bucket_name, object_name, tmp_path, _file):
+        ObjectWriter.__init__(self, storage, None, tmp_path, _file)
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.digest = sha256()
+
+    def _write(self, data):
+        self.digest.update(data)
+        self._file.write(data)
+
+    @defer.inlineCallbacks
+    def write(self, data):
+        yield self.storage._run('write', self._write, data)
+        self.size += len(data)
+        defer.returnValue(True)
+
+    def _publish(self, etag):
+        self.storage._sync_file(self._file)
+        self._file.close()
+        if etag is None:
+            m = md5()
+            with open(self.tmp_path, 'rb') as _file:
+                for chunk in iter(lambda: _file.read(1 << 20), ''):
+                    m.update(chunk)
+            etag = m.hexdigest()
+        self.storage._link_file(self.bucket_name, self.object_name, self.tmp_path, etag, self.size,
+                                self.digest.hexdigest())
+        return True
+
+class ExistingBlobWriter(object):
+    """Takes a body whose Content-MD5 and length match a stored blob without
+    writing it, the SHA-256 of what arrives has to match the blob as well."""
+    def __init__(self, storage, bucket_name, object_name, blob_digest, etag):
+        self.storage = storage
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.blob_digest = blob_digest
+        self.etag = etag
+        self.digest = sha256()
+        self.size = 0
+
+    @defer.inlineCallbacks
+    def write(self, data):
+        yield self.storage._run('write', self.digest.update, data)
+        self.size += len(data)
+        defer.returnValue(True)
+
+    def close(self, etag = None):
+        if etag is not None and etag != self.etag:
+            self.abort()
+            return defer.fail(BadDigest('Content-MD5 %s does not match the body (%s)' % (self.etag, etag)))
+        if self.digest.hexdigest() != self.blob_digest:
+            self.abort()
+            return defer.fail(BadDigest('The body has the MD5 %s of a stored blob but different content' % self.etag))
+        return self.storage._run('publish', self.storage._link_pinned, self.bucket_name, self.object_name,
+                                 self.blob_digest, self.etag, self.size)
+
+    def abort(self):
+        return self.storage._run('abort', self.storage._unpin, self.blob_digest)
+
+class ObjectStorage(FsObjectStorage.ObjectStorage):
+    def __init__(self, config = {}):
+        if "directory" not in config:
+            config["directory"] = "/tmp/otto-dedup"
+        FsObjectStorage.ObjectStorage.__init__(self, config)
+        log.msg('DedupObjectStorage.ObjectStorage loaded')
+        self.blob_directory = os.path.join(self.directory, '.otto', 'blobs')
+        if not os.path.isdir(self.blob_directory):
+            os.makedirs(self.blob_directory)
+        self.catalog = Catalog(os.path.join(self.directory, '.otto', 'catalog.db'))
+
+    def _index(self, bucket_name):
+        return BucketView(self.catalog, bucket_name)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_directory, digest[:2], digest[2:4], digest)
+
+    def _remove_blob(self, digest):
+        _blob = self._blob_path(digest)
+        if os.path.exists(_blob):
+            os.unlink(_blob)
+            log.msg('Removed unreferenced blob %s' % digest)
+
+    def _link_file(self, bucket_name, object_name, tmp_path, etag, size, digest = None):
+        if digest is None:
+            digest = _file_digest(tmp_path)
+        with self.catalog.lock:
+            _blob = self._blob_path(digest)
+            if os.path.exists(_blob):
+                os.unlink(tmp_path)
+            else:
+                _directory = os.path.dirname(_blob)
+                if not os.path.isdir(_directory):
+                    os.makedirs(_directory)
+                os.rename(tmp_path, _blob)
+                self._sync_directory(_directory)
+            orphan = self.catalog.link(bucket_name, object_name, digest, etag, size)
+            if orphan is not None:
+                self._remove_blob(orphan)
+
+    def _link_pinned(self, bucket_name, object_name, digest, etag, size):
+        with self.catalog.lock:
+            orphan = self.catalog.link(bucket_name, object_name, digest, etag, size, pinned=True)
+            if orphan is not None:
+                self._remove_blob(orphan)
+        return True
+
+    def _unpin(self, digest):
+        with self.catalog.lock:
+            if self.catalog.release(digest):
+                self._remove_blob(digest)
+
+    @defer.inlineCallbacks
+    def is_bucket(self, bucket_name, object_name = None):
+        if object_name is not None:
+            defer.returnValue(False)
+        result = yield self._run('is_bucket', self.catalog.is_bucket, bucket_name)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def is_object(self, bucket_name, object_name):
+        row = yield self._run('is_object', self.catalog.get, bucket_name, object_name)
+        defer.returnValue(row is not None)
+
+    @defer.inlineCallbacks
+    def list_buckets(self):
+        rows = yield self._run('list_buckets', self.catalog.list_buckets)
+        defer.returnValue([{
+                                'Name': name,
+                                'CreationDate': datetime.datetime.utcfromtimestamp(created),
+                           } for name, created in rows])
+
+    def create_bucket(self, bucket_name):
+        return self._run('create_bucket', self.catalog.create_bucket, bucket_name)
+
+    def delete_bucket(self, bucket_name):
+        return self._run('delete_bucket', self.catalog.delete_bucket, bucket_name)
+
+    def _row_stat(self, row):
+        key, size, mtime, etag, created, digest = row
+        return {
+                    'LastModified': datetime.datetime.utcfromtimestamp(mtime),
+                    'CreationDate': datetime.datetime.utcfromtimestamp(created),
+                    'Size': size,
+                    'ETag': etag
+               }
+
+    @defer.inlineCallbacks
+    def stat_object(self, bucket_name, object_name):
+        row = yield self._run('stat_object', self.catalog.get, bucket_name, object_name)
+        if row is None:
+            raise OSError('No such object %s on bucket %s' % (object_name, bucket_name))
+        defer.returnValue(self._row_stat(row))
+
+    def _open_object(self, bucket_name, object_name, _object = None):
+        with self.catalog.lock:
+            row = self.catalog.get(bucket_name, object_name)
+            if row is None:
+                return None
+            _file = open(self._blob_path(row[5]), 'rb')
+        return ObjectHandle(_file, self._row_stat(row), self.chunk_size, self.threadpool)
+
+    def open_object(self, bucket_name, object_name):
+        return self._run('open_object', self._open_object, bucket_name, object_name)
+
+    @defer.inlineCallbacks
+    def read_object(self, bucket_name, object_name):
+        handle = yield self.open_object(bucket_name, object_name)
+        try:
+            result = yield self._run('read_object', handle._file.read)
+        finally:
+            handle.close()
+        defer.returnValue(result)
+
+    def _open_object_writer(self, bucket_name, object_name, size = None, etag = None):
+        digest = etag is not None and size is not None and self.catalog.pin(etag, size)
+        if digest:
+            return ExistingBlobWriter(self, bucket_name, object_name, digest, etag)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_directory)
+        os.fchmod(fd, 0644)
+        return DedupWriter(self, bucket_name, object_name, tmp_path, os.fdopen(fd, 'wb'))
+
+    def open_object_writer(self, bucket_name, object_name, size = None, etag = None):
+        return self._run('open_object_writer', self._open_object_writer, bucket_name, object_name, size, etag)
+
+    def _publish_file(self, bucket_name, object_name, _object, tmp_path, etag):
+        self._link_file(bucket_name, object_name, tmp_path, etag, os.stat(tmp_path).st_size)
+
+    def _delete_object(self, bucket_name, object_name):
+        with self.catalog.lock:
+            found, orphan = self.catalog.unlink(bucket_name, object_name)
+            if orphan is not None:
+                self._remove_blob(orphan)
+        return found
+
+    def delete_object(self, bucket_name, object_name):
+        return self._run('delete_object', self._delete_object, bucket_name, object_name)
+
+    def _delete_objects(self, bucket_name, object_names):
+        for object_name in object_names:
+            self._delete_object(bucket_name, object_name)
+        return [(object_name, None) for object_name in object_names]
+
+    def _copy_object(self, source_bucket, source_name, bucket_name, object_name):
+        with self.catalog.lock:
+            row = self.catalog.get(source_bucket, source_name)
+            if row is None:
+                return None
+            orphan = self.catalog.link(bucket_name, object_name, row[5], row[3], row[1])
+            if orphan is not None:
+                self._remove_blob(orphan)
+            log.msg('Copied object %s/%s to %s/%s sharing blob %s' % (source_bucket, source_name, bucket_name, object_name, row[5]))
+            return self._row_stat(self.catalog.get(bucket_name, object_name))
+
+    def copy_object(self, source_bucket, source_name, bucket_name, object_name):
+        return self._run('copy_object', self._copy_object, source_bucket, source_name, bucket_name, object_name)
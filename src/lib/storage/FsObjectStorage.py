@@ -1,8 +1,439 @@
 import os
-import bisect
+import re
+import errno
+import fcntl
+import json
+import mmap
+import ctypes
+import ctypes.util
+import stat
+import uuid
+import shutil
+import sqlite3
+import time
 import datetime
-from twisted.python import log
-from twisted.internet import defer
+import urllib
+import hashlib
+import tempfile
+import threading
+from twisted.python import log, failure, threadpool
+from twisted.internet import defer, interfaces, reactor, threads
+from zope.interface import implements
+from otto.storage import StorageBusy, NoSuchUpload, InvalidPart, InvalidName, BucketNotEmpty, ObjectIterator, \
+    multipart_etag, valid_bucket_name
+
+class MmapSender(object):
+    implements(interfaces.IPullProducer)
+
+    def __init__(self, _map, chunk_size):
+        self._map = _map
+        self.chunk_size = chunk_size
+
+    def beginTransfer(self, consumer, offset, length):
+        self._offset = offset
+        self._end = offset + length
+        self.consumer = consumer
+        self.deferred = defer.Deferred()
+        consumer.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        if self._map is None:
+            return
+        chunk_end = min(self._offset + self.chunk_size, self._end)
+        self.consumer.write(self._map[self._offset:chunk_end])
+        self._offset = chunk_end
+        if self._offset >= self._end:
+            self._map = None
+            self.consumer.unregisterProducer()
+            self.deferred.callback(True)
+
+    def stopProducing(self):
+        if self._map is not None:
+            self._map = None
+            self.deferred.errback(Exception('Consumer asked us to stop producing'))
+
+class PooledFileSender(object):
+    """Streams a file with preads on the storage thread pool, so reading a
+    file that is not in the page cache never blocks the reactor"""
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, _file, chunk_size, threadpool):
+        self._file = _file
+        self.chunk_size = chunk_size
+        self.threadpool = threadpool
+        self.paused = False
+        self.reading = False
+        self.done = False
+
+    def beginTransfer(self, consumer, offset, length):
+        self._offset = offset
+        self._end = offset + length
+        self.consumer = consumer
+        self.deferred = defer.Deferred()
+        consumer.registerProducer(self, True)
+        self._read()
+        return self.deferred
+
+    def _read(self):
+        if self.paused or self.reading or self.done:
+            return
+        self.reading = True
+        d = threads.deferToThreadPool(reactor, self.threadpool, _pread, self._file.fileno(),
+                                      min(self.chunk_size, self._end - self._offset), self._offset)
+        d.addCallbacks(self._write, self._finish)
+
+    def _write(self, data):
+        self.reading = False
+        if self.done:
+            return
+        if not data:
+            return self._finish(failure.Failure(IOError('File ended %d bytes early' % (self._end - self._offset))))
+        self._offset += len(data)
+        self.consumer.write(data)
+        if self._offset >= self._end:
+            return self._finish(True)
+        self._read()
+
+    def _finish(self, result):
+        self.reading = False
+        if self.done:
+            return
+        self.done = True
+        self.consumer.unregisterProducer()
+        if isinstance(result, failure.Failure):
+            self.deferred.errback(result)
+        else:
+            self.deferred.callback(result)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._read()
+
+    def stopProducing(self):
+        if not self.done:
+            self.done = True
+            self.deferred.errback(Exception('Consumer asked us to stop producing'))
+
+class ObjectHandle(object):
+    def __init__(self, _file, stat, chunk_size, threadpool = None):
+        self._file = _file
+        self._map = None
+        self.stat = stat
+        self.chunk_size = chunk_size
+        self.threadpool = threadpool
+
+    def stream(self, consumer, offset = 0, length = None):
+        size = self.stat['Size']
+        if length is None:
+            length = size - offset
+        length = max(min(length, size - offset), 0)
+        if not length:
+            return defer.succeed(True)
+        if self.threadpool is not None:
+            return PooledFileSender(self._file, self.chunk_size, self.threadpool).beginTransfer(consumer, offset, length)
+        if self._map is None:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return MmapSender(self._map, self.chunk_size).beginTransfer(consumer, offset, length)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+FICLONE = 0x40049409
+
+def _libc_function(name, restype, *argtypes):
+    function = getattr(_libc, name, None)
+    if function is not None:
+        function.restype = restype
+        function.argtypes = argtypes
+    return function
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_copy_file_range = _libc_function('copy_file_range', ctypes.c_ssize_t, ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+_sendfile = _libc_function('sendfile', ctypes.c_ssize_t, ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+_libc_pread = _libc_function('pread64', ctypes.c_ssize_t, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_int64) or \
+              _libc_function('pread', ctypes.c_ssize_t, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64)
+
+def _pread(fd, count, offset):
+    """os.pread, which python 2 lacks: reads without moving the file offset,
+    so any thread can read any part of a shared file"""
+    buf = ctypes.create_string_buffer(count)
+    while True:
+        result = _libc_pread(fd, buf, count, offset)
+        if result >= 0:
+            return buf.raw[:result]
+        error = ctypes.get_errno()
+        if error != errno.EINTR:
+            raise OSError(error, os.strerror(error))
+
+def _kernel_copy(source_fd, target_fd, length):
+    """Copies up to length bytes between the current offsets of two file
+    descriptors without passing them through python, with copy_file_range or
+    else sendfile. Returns how many were copied, short when neither works."""
+    copied = 0
+    for function in (_copy_file_range, _sendfile):
+        if function is None:
+            continue
+        while copied < length:
+            count = min(length - copied, 1 << 30)
+            if function is _copy_file_range:
+                result = function(source_fd, None, target_fd, None, count, 0)
+            else:
+                result = function(target_fd, source_fd, None, count)
+            if result < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    break
+                raise OSError(error, os.strerror(error))
+            if result == 0:
+                return copied
+            copied += result
+        if copied >= length:
+            break
+    return copied
+
+def _copy_file(source_fd, target_fd, length):
+    """Copies length bytes from source_fd to target_fd, in the kernel where
+    it can, and returns how many there were before the end of the source"""
+    copied = _kernel_copy(source_fd, target_fd, length)
+    while copied < length:
+        data = os.read(source_fd, min(length - copied, 1 << 20))
+        if not data:
+            break
+        while data:
+            written = os.write(target_fd, data)
+            data = data[written:]
+            copied += written
+    return copied
+
+def _clone_file(source, target):
+    """Copies the open file source into target, sharing the data extents on
+    filesystems with reflinks (btrfs, xfs) and copying them in the kernel
+    elsewhere"""
+    try:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return True
+    except (IOError, OSError):
+        _copy_file(source.fileno(), target.fileno(), os.fstat(source.fileno()).st_size)
+        return False
+
+def _unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+MAX_NAME = 200
+
+class FlatLayout(object):
+    """Keys map straight to paths under the bucket directory, '/' included."""
+    def object_path(self, bucket_path, object_name):
+        return os.path.join(bucket_path, object_name)
+
+    def object_key(self, bucket_path, path):
+        return os.path.relpath(path, bucket_path)
+
+    def record_key(self, path, object_name):
+        pass
+
+    def forget_key(self, path):
+        pass
+
+    def __str__(self):
+        return 'flat'
+
+class ShardedLayout(object):
+    """Keys live depth directories down, named after the md5 of the key, in a
+    file named after the quoted key. Keys quoting to more than MAX_NAME bytes
+    use the sha1 of the key plus a .key file holding the key itself."""
+    def __init__(self, depth = 2, width = 2):
+        self.depth = depth
+        self.width = width
+
+    def object_path(self, bucket_path, object_name):
+        key = _unicode(object_name).encode('utf-8')
+        digest = hashlib.md5(key).hexdigest()
+        shards = [digest[level * self.width:(level + 1) * self.width] for level in range(self.depth)]
+        name = urllib.quote(key, safe='')
+        if name.startswith('.'):
+            name = '%2E' + name[1:]
+        if len(name) > MAX_NAME:
+            name = hashlib.sha1(key).hexdigest() + '.long'
+        return os.path.join(bucket_path, *(shards + [name]))
+
+    def object_key(self, bucket_path, path):
+        name = os.path.basename(path)
+        if name.endswith('.key'):
+            return None
+        if name.endswith('.long'):
+            try:
+                return open('%s.key' % path).read()
+            except IOError:
+                return None
+        return urllib.unquote(name)
+
+    def record_key(self, path, object_name):
+        if path.endswith('.long'):
+            open('%s.key' % path, 'w').write(_unicode(object_name).encode('utf-8'))
+
+    def forget_key(self, path):
+        if path.endswith('.long') and os.path.exists('%s.key' % path):
+            os.unlink('%s.key' % path)
+
+    def __str__(self):
+        return 'sharded %d %d' % (self.depth, self.width)
+
+def parse_layout(description):
+    fields = description.split()
+    if fields[0] == 'flat':
+        return FlatLayout()
+    if fields[0] == 'sharded':
+        return ShardedLayout(*[int(field) for field in fields[1:]])
+    raise ValueError('Unknown FsObjectStorage layout %s' % description)
+
+class BucketIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.complete = False
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, size INTEGER, mtime REAL, etag TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+
+    def is_complete(self):
+        if not self.complete:
+            with self.lock:
+                row = self.db.execute("SELECT value FROM meta WHERE name = 'complete'").fetchone()
+            self.complete = row is not None
+        return self.complete
+
+    def mark_complete(self):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('complete', '1')")
+        self.complete = True
+
+    def rebuild(self, bucket_path, layout = None, batch_size = 1000):
+        """Indexes the object files under bucket_path while the index stays in
+        use, committing a batch at a time. Rows written meanwhile keep their
+        etag, rows of files that are gone are dropped at the end."""
+        layout = layout or FlatLayout()
+        rows = []
+        for root, dirs, files in os.walk(bucket_path):
+            for file_name in files:
+                _object = os.path.join(root, file_name)
+                key = layout.object_key(bucket_path, _object)
+                if key is None:
+                    continue
+                try:
+                    _stat = os.stat(_object)
+                except OSError:
+                    continue
+                rows.append((_stat.st_size, _stat.st_mtime, _unicode(key)))
+                if len(rows) >= batch_size:
+                    self._merge(rows)
+                    rows = []
+        self._merge(rows)
+        self.delete_many([key for key in self.keys() if not os.path.isfile(layout.object_path(bucket_path, key))])
+        self.mark_complete()
+
+    def _merge(self, rows):
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('UPDATE objects SET size = ?, mtime = ? WHERE key = ? AND etag IS NULL', rows)
+            self.db.executemany('INSERT OR IGNORE INTO objects VALUES (?, ?, ?, NULL)',
+                                [(key, size, mtime) for size, mtime, key in rows])
+            self.db.execute('COMMIT')
+
+    def put(self, key, size, mtime, etag = None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)', (_unicode(key), size, mtime, etag))
+
+    def get(self, key):
+        with self.lock:
+            return self.db.execute('SELECT key, size, mtime, etag FROM objects WHERE key = ?', (_unicode(key),)).fetchone()
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT key FROM objects ORDER BY key')]
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM objects WHERE key = ?', (_unicode(key),))
+
+    def delete_many(self, keys):
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM objects WHERE key = ?', [(_unicode(key),) for key in keys])
+            self.db.execute('COMMIT')
+
+    def page(self, marker = None, prefix = None, max_keys = 5000):
+        query = 'SELECT key, size, mtime, etag FROM objects WHERE key >= ?'
+        args = [_unicode(prefix or u'')]
+        if marker:
+            query += ' AND key > ?'
+            args.append(_unicode(marker))
+        query += ' ORDER BY key LIMIT ?'
+        args.append(max_keys + 1)
+        prefix = _unicode(prefix or u'').encode('utf-8')
+        rows = []
+        with self.lock:
+            for row in self.db.execute(query, args):
+                if not row[0].startswith(prefix):
+                    break
+                rows.append(row)
+        return rows[:max_keys], len(rows) > max_keys
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class ObjectWriter(object):
+    def __init__(self, storage, path, tmp_path, _file, on_publish = None):
+        self.storage = storage
+        self.path = path
+        self.tmp_path = tmp_path
+        self.on_publish = on_publish
+        self.size = 0
+        self._file = _file
+
+    @defer.inlineCallbacks
+    def write(self, data):
+        yield self.storage._run('write', self._file.write, data)
+        self.size += len(data)
+        defer.returnValue(True)
+
+    def close(self, etag = None):
+        return self.storage._run('publish', self._publish, etag)
+
+    def _publish(self, etag):
+        self.storage._sync_file(self._file)
+        self._file.close()
+        _directory = os.path.dirname(self.path)
+        if not os.path.isdir(_directory):
+            os.makedirs(_directory)
+        os.rename(self.tmp_path, self.path)
+        self.storage._sync_directory(_directory)
+        if self.on_publish is not None:
+            self.on_publish(self.path, etag)
+        return True
+
+    def abort(self):
+        return self.storage._run('abort', self._discard)
+
+    def _discard(self):
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
 
 class ObjectStorage(object):
     def __init__(self, config = {}):
@@ -10,129 +441,570 @@ class ObjectStorage(object):
         if "directory" not in config:
             config["directory"] = "/tmp/otto"
         self.directory = config["directory"]
+        self.chunk_size = int(config.get("chunk_size", 65536))
+        self.listing_batch_size = int(config.get("listing_batch_size", 1000))
+        self.delete_batch_size = int(config.get("delete_batch_size", 100))
+        layout = config.get("layout", "flat")
+        if layout == "sharded":
+            layout = "sharded %s %s" % (config.get("shard_depth", 2), config.get("shard_width", 2))
+        self.layout = parse_layout(layout)
+        self.fsync = config.get("fsync", "none")
+        if self.fsync not in ("none", "data", "full"):
+            raise ValueError('fsync must be none, data or full, not %s' % self.fsync)
+        self.tmp_directory = os.path.join(self.directory, '.otto', 'tmp')
+        self.index_directory = os.path.join(self.directory, '.otto', 'index')
+        self.uploads_directory = os.path.join(self.directory, '.otto', 'uploads')
+        for _directory in (self.tmp_directory, self.index_directory, self.uploads_directory):
+            if not os.path.isdir(_directory):
+                os.makedirs(_directory)
+        self._check_layout()
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        self._rebuilding = set()
+        self.io_threads = int(config.get("io_threads", 0))
+        self.io_queue_limit = int(config.get("io_queue_limit", 0))
+        self.io_pending = 0
+        self.io_stats = {}
+        self.threadpool = None
+        if self.io_threads > 0:
+            self.threadpool = threadpool.ThreadPool(1, self.io_threads, 'FsObjectStorage')
+            reactor.callWhenRunning(self.threadpool.start)
+            reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
+            log.msg('FsObjectStorage running blocking I/O on %d threads' % self.io_threads)
+
+    def _check_layout(self):
+        marker = os.path.join(self.directory, '.otto', 'layout')
+        if not os.path.exists(marker):
+            # trees from before the marker existed are always flat
+            existing = [name for name in os.listdir(self.directory) if not name.startswith('.')]
+            open(marker, 'w').write(existing and 'flat' or str(self.layout))
+        stored = open(marker).read().strip()
+        if stored != str(self.layout):
+            raise ValueError('%s uses the "%s" layout, not "%s"; run otto.storage.fsmigrate first' % (
+                             self.directory, stored, self.layout))
+        log.msg('FsObjectStorage using the %s layout, fsync %s' % (self.layout, self.fsync))
+
+    def _sync_file(self, _file):
+        if self.fsync != 'none':
+            _file.flush()
+            os.fsync(_file.fileno())
+
+    def _sync_path(self, path):
+        if self.fsync != 'none':
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _sync_directory(self, _directory):
+        if self.fsync == 'full':
+            self._sync_path(_directory)
+
+    def _run(self, operation, function, *args, **kwargs):
+        if self.threadpool is None:
+            started = time.time()
+            d = defer.maybeDeferred(function, *args, **kwargs)
+        else:
+            if self.io_queue_limit and self.io_pending >= self.io_queue_limit:
+                return defer.fail(StorageBusy('FsObjectStorage I/O queue is full (%d pending)' % self.io_pending))
+            self.io_pending += 1
+            started = time.time()
+            d = threads.deferToThreadPool(reactor, self.threadpool, function, *args, **kwargs)
+        d.addBoth(self._done, operation, started)
+        return d
+
+    def _run_in_thread(self, operation, function, *args, **kwargs):
+        """Like _run, but on the reactor's thread pool when io_threads is 0,
+        for calls that copy whole objects and must never block the reactor"""
+        if self.threadpool is not None:
+            return self._run(operation, function, *args, **kwargs)
+        started = time.time()
+        d = threads.deferToThread(function, *args, **kwargs)
+        d.addBoth(self._done, operation, started)
+        return d
+
+    def _done(self, result, operation, started):
+        if self.threadpool is not None:
+            self.io_pending -= 1
+        elapsed = time.time() - started
+        _stats = self.io_stats.get(operation)
+        if _stats is None:
+            _stats = self.io_stats[operation] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+        _stats['count'] += 1
+        _stats['total'] += elapsed
+        _stats['max'] = max(_stats['max'], elapsed)
+        if isinstance(result, failure.Failure):
+            _stats['errors'] += 1
+        return result
+
+    def _index_path(self, bucket_name):
+        return os.path.join(self.index_directory, '%s.db' % bucket_name)
+
+    def _index(self, bucket_name):
+        with self._indexes_lock:
+            index = self._indexes.get(bucket_name)
+            if index is None:
+                index = self._indexes[bucket_name] = BucketIndex(self._index_path(bucket_name))
+            rebuild = not index.is_complete() and bucket_name not in self._rebuilding
+            if rebuild:
+                self._rebuilding.add(bucket_name)
+        if rebuild:
+            # trees from before the index existed, walked in the background
+            thread = threading.Thread(target=self._rebuild_index, args=(bucket_name, index),
+                                      name='FsObjectStorage index %s' % bucket_name)
+            thread.daemon = True
+            thread.start()
+        return index
+
+    def _rebuild_index(self, bucket_name, index):
+        try:
+            # the other worker processes wait for whichever one got here first
+            with open('%s.lock' % index.path, 'w') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                index.complete = False
+                if not index.is_complete():
+                    started = time.time()
+                    log.msg('Building key index for bucket %s' % bucket_name)
+                    index.rebuild(self._bucket_path(bucket_name), self.layout)
+                    log.msg('Built key index for bucket %s in %.1fs' % (bucket_name, time.time() - started))
+        except Exception, e:
+            log.msg('Building key index for bucket %s failed: %s' % (bucket_name, e))
+        finally:
+            with self._indexes_lock:
+                self._rebuilding.discard(bucket_name)
+
+    def _page(self, bucket_name, marker, prefix, max_keys):
+        index = self._index(bucket_name)
+        if not index.is_complete():
+            raise StorageBusy('Key index of bucket %s is still being built' % bucket_name)
+        return index.page(marker, prefix, max_keys)
+
+    def _drop_index(self, bucket_name):
+        with self._indexes_lock:
+            index = self._indexes.pop(bucket_name, None)
+            if index is not None:
+                index.close()
+            _index = self._index_path(bucket_name)
+            for path in (_index, '%s.lock' % _index):
+                if os.path.exists(path):
+                    os.unlink(path)
 
     @defer.inlineCallbacks
     def __object_path__(self, bucket_name, object_name = None):
         if object_name:
-            result = yield os.path.abspath(os.path.join(self.directory, bucket_name, object_name))
+            result = yield self._object_path(bucket_name, object_name)
             defer.returnValue(result)
-        result = yield os.path.abspath(os.path.join(self.directory, bucket_name))
+        result = yield self._bucket_path(bucket_name)
         defer.returnValue(result)
 
+    def _bucket_path(self, bucket_name):
+        # .otto holds the indexes, uploads and temp files, it is never a bucket
+        if not valid_bucket_name(bucket_name):
+            raise InvalidName('Invalid bucket name %s' % bucket_name)
+        return os.path.abspath(os.path.join(self.directory, bucket_name))
+
+    def _object_path(self, bucket_name, object_name):
+        _bucket = self._bucket_path(bucket_name)
+        _object = os.path.abspath(self.layout.object_path(_bucket, object_name))
+        if not _object.startswith(_bucket + os.sep):
+            raise InvalidName('Invalid object name %s' % object_name)
+        return _object
+
     @defer.inlineCallbacks
     def is_bucket(self, bucket_name, object_name = None):
-        _bucket = yield self.__object_path__(bucket_name, object_name)
-        if os.path.isdir(_bucket):
-            defer.returnValue(True)
-        else:
+        if bucket_name.startswith('.'):
             defer.returnValue(False)
+        _bucket = yield self.__object_path__(bucket_name, object_name)
+        result = yield self._run('is_bucket', os.path.isdir, _bucket)
+        defer.returnValue(result)
 
     @defer.inlineCallbacks
     def is_object(self, bucket_name, object_name):
         _object = yield self.__object_path__(bucket_name, object_name)
-        if os.path.isfile(_object):
-            defer.returnValue(True)
-        else:
-            defer.returnValue(False)
+        result = yield self._run('is_object', os.path.isfile, _object)
+        defer.returnValue(result)
 
-    @defer.inlineCallbacks
-    def list_buckets(self):
+    def _list_buckets(self):
         buckets = []
         for bucket_name in os.listdir(self.directory):
-            _bucket = yield self.__object_path__(bucket_name)
+            if bucket_name.startswith('.'):
+                continue
+            _bucket = os.path.abspath(os.path.join(self.directory, bucket_name))
             buckets.append({
                 'Name': bucket_name,
                 'CreationDate': datetime.datetime.utcfromtimestamp(os.stat(_bucket).st_ctime),
             })
-        defer.returnValue(buckets)
+        return buckets
 
-    @defer.inlineCallbacks
-    def create_bucket(self, bucket_name):
-        _bucket = yield self.__object_path__(bucket_name)
+    def list_buckets(self):
+        return self._run('list_buckets', self._list_buckets)
+
+    def _create_bucket(self, bucket_name, _bucket):
         if not os.path.isdir(_bucket):
             os.makedirs(_bucket)
+            self._drop_index(bucket_name)
+            with self._indexes_lock:
+                index = self._indexes[bucket_name] = BucketIndex(self._index_path(bucket_name))
+            index.mark_complete()
             log.msg('Created bucket %s' % bucket_name)
-            defer.returnValue(True)
-        else:
-            defer.returnValue(False)
+            return True
+        return False
 
     @defer.inlineCallbacks
-    def delete_bucket(self, bucket_name):
+    def create_bucket(self, bucket_name):
         _bucket = yield self.__object_path__(bucket_name)
+        result = yield self._run('create_bucket', self._create_bucket, bucket_name, _bucket)
+        defer.returnValue(result)
+
+    def _delete_bucket(self, bucket_name, _bucket):
         if os.path.isdir(_bucket):
-            os.rmdir(_bucket)
+            # shard and key prefix directories are left behind empty by deletes
+            for root, dirs, files in os.walk(_bucket, topdown=False):
+                if files:
+                    raise BucketNotEmpty(bucket_name)
+                os.rmdir(root)
+            self._drop_index(bucket_name)
             log.msg('Delete bucket %s' % bucket_name)
-            defer.returnValue(True)
-        else:
-            defer.returnValue(False)
+            return True
+        return False
 
     @defer.inlineCallbacks
-    def list_objects(self, bucket_name, marker = None, prefix = None, max_keys = 5000, terse = None):
-        objects = []
-        start_pos = 0
-        truncated = False
+    def delete_bucket(self, bucket_name):
         _bucket = yield self.__object_path__(bucket_name)
-        [ objects.append(file_name) for root, dirs, files in os.walk(_bucket) for file_name in files ]
-        if marker:
-            start_pos = bisect.bisect_right(objects, marker, start_pos)
-        if prefix:
-            start_pos = bisect.bisect_left(objects, prefix, start_pos)
+        result = yield self._run('delete_bucket', self._delete_bucket, bucket_name, _bucket)
+        defer.returnValue(result)
+
+    def iter_objects(self, bucket_name, marker = None, prefix = None, max_keys = 5000, terse = None):
+        return ObjectIterator(self.list_objects, bucket_name, marker, prefix, max_keys, terse, self.listing_batch_size)
 
+    @defer.inlineCallbacks
+    def list_objects(self, bucket_name, marker = None, prefix = None, max_keys = 5000, terse = None):
+        rows, truncated = yield self._run('list_objects', self._page, bucket_name, marker, prefix, max_keys)
         contents = []
-        for _object in objects[start_pos:]:
-            if not _object.startswith(prefix):
-                break
-            if len(contents) >= max_keys:
-                truncated = True
-                break
-            content = {'Key': _object}
+        for key, size, mtime, etag in rows:
+            content = {'Key': key}
             if not terse:
-                _object_path = yield self.__object_path__(bucket_name, _object)
-                _stat = os.stat(_object_path)
                 content.update({
-                    'LastModified': datetime.datetime.utcfromtimestamp(_stat.st_mtime),
-                    'Size': _stat.st_size,
+                    'LastModified': datetime.datetime.utcfromtimestamp(mtime),
+                    'Size': size,
                 })
+                if etag:
+                    content['ETag'] = '"%s"' % etag
             contents.append(content)
-            marker = _object
 
-        defer.returnValue({ 
-                            'Name': bucket_name, 
-                            'Prefix': prefix, 
-                            'Marker': marker, 
-                            'MaxKeys': max_keys, 
-                            'IsTruncated': truncated, 
-                            'Contents': contents
-                          })
+        result = { 
+                    'Name': bucket_name, 
+                    'Prefix': prefix, 
+                    'Marker': marker, 
+                    'MaxKeys': max_keys, 
+                    'IsTruncated': truncated, 
+                    'Contents': contents
+                 }
+        if truncated:
+            result['NextMarker'] = rows[-1][0]
+        defer.returnValue(result)
+
+    def _stat_record(self, bucket_name, object_name, _stat):
+        result = {
+                    'LastModified': datetime.datetime.utcfromtimestamp(_stat.st_mtime), 
+                    'CreationDate': datetime.datetime.utcfromtimestamp(_stat.st_ctime),
+                    'Size': _stat.st_size
+                 }
+        row = self._index(bucket_name).get(object_name)
+        if row is not None and row[3] and row[1] == _stat.st_size and row[2] == _stat.st_mtime:
+            result['ETag'] = row[3]
+        return result
 
     @defer.inlineCallbacks
     def stat_object(self, bucket_name, object_name):
         _object = yield self.__object_path__(bucket_name, object_name)
-        _stat = os.stat(_object)
-        defer.returnValue({
-                            'LastModified': datetime.datetime.utcfromtimestamp(_stat.st_mtime), 
-                            'CreationDate': datetime.datetime.utcfromtimestamp(_stat.st_ctime),
-                            'Size': _stat.st_size
-                          })
+        result = yield self._run('stat_object', lambda: self._stat_record(bucket_name, object_name, os.stat(_object)))
+        defer.returnValue(result)
+
+    def _open_object(self, bucket_name, object_name, _object):
+        try:
+            _file = open(_object, 'rb')
+        except IOError:
+            return None
+        _stat = os.fstat(_file.fileno())
+        if not stat.S_ISREG(_stat.st_mode):
+            _file.close()
+            return None
+        return ObjectHandle(_file, self._stat_record(bucket_name, object_name, _stat), self.chunk_size, self.threadpool)
+
+    @defer.inlineCallbacks
+    def open_object(self, bucket_name, object_name):
+        _object = yield self.__object_path__(bucket_name, object_name)
+        result = yield self._run('open_object', self._open_object, bucket_name, object_name, _object)
+        defer.returnValue(result)
 
     @defer.inlineCallbacks
     def read_object(self, bucket_name, object_name):
         _object = yield self.__object_path__(bucket_name, object_name)
-        defer.returnValue(open(_object).read())
+        result = yield self._run('read_object', lambda: open(_object).read())
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def stream_object(self, bucket_name, object_name, consumer, offset = 0, length = None):
+        handle = yield self.open_object(bucket_name, object_name)
+        try:
+            result = yield handle.stream(consumer, offset, length)
+        finally:
+            handle.close()
+        defer.returnValue(result)
+
+    def _index_object(self, bucket_name, object_name, _object, etag):
+        self.layout.record_key(_object, object_name)
+        _stat = os.stat(_object)
+        self._index(bucket_name).put(object_name, _stat.st_size, _stat.st_mtime, etag)
+
+    def _open_object_writer(self, bucket_name, object_name, _object):
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_directory)
+        os.fchmod(fd, 0644)
+        return ObjectWriter(self, _object, tmp_path, os.fdopen(fd, 'wb'),
+                            lambda path, etag: self._index_object(bucket_name, object_name, path, etag))
 
     @defer.inlineCallbacks
-    def write_object(self, bucket_name, object_name, content):
+    def open_object_writer(self, bucket_name, object_name, size = None, etag = None):
         _object = yield self.__object_path__(bucket_name, object_name)
-        open(_object, 'w').write(content)
-        log.msg('Created object %s on bucket %s' % (object_name, bucket_name))
+        writer = yield self._run('open_object_writer', self._open_object_writer, bucket_name, object_name, _object)
+        defer.returnValue(writer)
+
+    @defer.inlineCallbacks
+    def write_object(self, bucket_name, object_name, content, etag = None):
+        writer = yield self.open_object_writer(bucket_name, object_name, len(content), etag)
+        try:
+            yield writer.write(content)
+        except:
+            writer.abort()
+            raise
+        yield writer.close(etag)
         defer.returnValue(True)
 
+    def _delete_object(self, bucket_name, object_name, _object):
+        if os.path.isfile(_object):
+            os.unlink(_object)
+            self.layout.forget_key(_object)
+            self._index(bucket_name).delete(object_name)
+            return True
+        return False
+
     @defer.inlineCallbacks
     def delete_object(self, bucket_name, object_name):
         _object = yield self.__object_path__(bucket_name, object_name)
-        if os.path.isfile(_object):
-            os.unlink(_object)
-            log.msg('Deleted object %s on bucket %s' % (object_name, bucket_name))
-            defer.returnValue(True)
-        else:
-            defer.returnValue(False)
+        result = yield self._run('delete_object', self._delete_object, bucket_name, object_name, _object)
+        defer.returnValue(result)
+
+    def _delete_objects(self, bucket_name, object_names):
+        results = []
+        deleted = []
+        for object_name in object_names:
+            try:
+                _object = self._object_path(bucket_name, object_name)
+            except InvalidName, e:
+                results.append((object_name, e.log_message))
+                continue
+            try:
+                os.unlink(_object)
+                self.layout.forget_key(_object)
+                deleted.append(object_name)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.EISDIR):
+                    results.append((object_name, e.strerror))
+                    continue
+            results.append((object_name, None))
+        if deleted:
+            self._index(bucket_name).delete_many(deleted)
+        log.msg('Deleted %d of %d objects on bucket %s' % (len(deleted), len(object_names), bucket_name))
+        return results
+
+    def _delete_batch(self, bucket_name, batch):
+        d = self._run('delete_objects', self._delete_objects, bucket_name, batch)
+        d.addErrback(lambda failure: [(object_name, failure.getErrorMessage()) for object_name in batch])
+        return d
+
+    @defer.inlineCallbacks
+    def delete_objects(self, bucket_name, object_names):
+        semaphore = defer.DeferredSemaphore(max(1, self.io_threads))
+        batches = [object_names[offset:offset + self.delete_batch_size]
+                   for offset in xrange(0, len(object_names), self.delete_batch_size)]
+        results = yield defer.gatherResults([semaphore.run(self._delete_batch, bucket_name, batch) for batch in batches])
+        defer.returnValue([result for batch in results for result in batch])
+
+    def _upload_directory(self, upload_id):
+        if not re.match(r'^[0-9a-f]{32}$', upload_id or ''):
+            raise NoSuchUpload(upload_id)
+        return os.path.join(self.uploads_directory, upload_id)
+
+    def _upload_record(self, upload_id, bucket_name = None, object_name = None):
+        try:
+            record = json.load(open(os.path.join(self._upload_directory(upload_id), 'upload.json')))
+        except IOError:
+            raise NoSuchUpload(upload_id)
+        if bucket_name is not None and (record['Bucket'] != _unicode(bucket_name) or
+                                        record['Key'] != _unicode(object_name)):
+            raise NoSuchUpload(upload_id)
+        return record
+
+    def _create_multipart_upload(self, bucket_name, object_name):
+        upload_id = uuid.uuid4().hex
+        _upload = self._upload_directory(upload_id)
+        os.makedirs(_upload)
+        json.dump({'Bucket': bucket_name, 'Key': object_name, 'Initiated': time.time()},
+                  open(os.path.join(_upload, 'upload.json'), 'w'))
+        log.msg('Initiated upload %s of object %s on bucket %s' % (upload_id, object_name, bucket_name))
+        return upload_id
+
+    def create_multipart_upload(self, bucket_name, object_name):
+        return self._run('create_multipart_upload', self._create_multipart_upload, bucket_name, object_name)
+
+    def _write_part_etag(self, path, etag):
+        open('%s.etag' % path, 'w').write(etag or '')
+
+    def _open_part_writer(self, bucket_name, object_name, upload_id, part_number):
+        self._upload_record(upload_id, bucket_name, object_name)
+        _part = os.path.join(self._upload_directory(upload_id), '%05d' % part_number)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_directory)
+        os.fchmod(fd, 0644)
+        return ObjectWriter(self, _part, tmp_path, os.fdopen(fd, 'wb'), self._write_part_etag)
+
+    def open_part_writer(self, bucket_name, object_name, upload_id, part_number, size = None):
+        return self._run('open_part_writer', self._open_part_writer, bucket_name, object_name, upload_id, part_number)
+
+    def _list_parts(self, bucket_name, object_name, upload_id):
+        record = self._upload_record(upload_id, bucket_name, object_name)
+        _upload = self._upload_directory(upload_id)
+        parts = []
+        for part_name in sorted(os.listdir(_upload)):
+            if not part_name.isdigit():
+                continue
+            _part = os.path.join(_upload, part_name)
+            _stat = os.stat(_part)
+            try:
+                etag = open('%s.etag' % _part).read()
+            except IOError:
+                continue
+            parts.append({
+                            'PartNumber': int(part_name),
+                            'ETag': etag,
+                            'Size': _stat.st_size,
+                            'LastModified': datetime.datetime.utcfromtimestamp(_stat.st_mtime)
+                         })
+        return record, parts
+
+    def list_parts(self, bucket_name, object_name, upload_id):
+        return self._run('list_parts', self._list_parts, bucket_name, object_name, upload_id)
+
+    def _assemble_parts(self, bucket_name, object_name, upload_id, parts):
+        self._upload_record(upload_id, bucket_name, object_name)
+        _upload = self._upload_directory(upload_id)
+        _parts = []
+        for part_number, etag in parts:
+            _part = os.path.join(_upload, '%05d' % part_number)
+            try:
+                stored_etag = open('%s.etag' % _part).read()
+            except IOError:
+                raise InvalidPart('Part %d of upload %s was never uploaded' % (part_number, upload_id))
+            if stored_etag != etag:
+                raise InvalidPart('Part %d of upload %s has ETag %s, not %s' % (part_number, upload_id, stored_etag, etag))
+            _parts.append(_part)
+
+        # the first part becomes the object file, only the rest get appended
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_directory)
+        os.close(fd)
+        first_size = os.path.getsize(_parts[0])
+        os.rename(_parts[0], tmp_path)
+        try:
+            # not O_APPEND, copy_file_range refuses to write to those
+            fd = os.open(tmp_path, os.O_WRONLY)
+            try:
+                os.lseek(fd, 0, os.SEEK_END)
+                for _part in _parts[1:]:
+                    with open(_part, 'rb') as _source:
+                        size = os.fstat(_source.fileno()).st_size
+                        if _copy_file(_source.fileno(), fd, size) != size:
+                            raise IOError('Part %s of upload %s changed while it was assembled' % (_part, upload_id))
+            finally:
+                os.close(fd)
+            self._sync_path(tmp_path)
+        except:
+            self._restore_first_part(tmp_path, _parts[0], first_size)
+            raise
+        return tmp_path, _parts[0], first_size
+
+    def _restore_first_part(self, tmp_path, _part, size):
+        """Cuts the parts appended to the first one off again and puts it back,
+        so a retried completion does not publish them twice"""
+        with open(tmp_path, 'r+b') as _file:
+            _file.truncate(size)
+        os.rename(tmp_path, _part)
+
+    def _publish_file(self, bucket_name, object_name, _object, tmp_path, etag):
+        _directory = os.path.dirname(_object)
+        if not os.path.isdir(_directory):
+            os.makedirs(_directory)
+        os.rename(tmp_path, _object)
+        self._sync_directory(_directory)
+        self._index_object(bucket_name, object_name, _object, etag)
+
+    def _copy_object(self, source_bucket, source_name, bucket_name, object_name, _source, _object):
+        try:
+            source = open(_source, 'rb')
+        except IOError:
+            return None
+        with source:
+            _stat = os.fstat(source.fileno())
+            if not stat.S_ISREG(_stat.st_mode):
+                return None
+            etag = self._stat_record(source_bucket, source_name, _stat).get('ETag')
+            fd, tmp_path = tempfile.mkstemp(dir=self.tmp_directory)
+            os.fchmod(fd, 0644)
+            try:
+                with os.fdopen(fd, 'wb') as target:
+                    cloned = _clone_file(source, target)
+                    self._sync_file(target)
+            except:
+                os.unlink(tmp_path)
+                raise
+        self._publish_file(bucket_name, object_name, _object, tmp_path, etag)
+        log.msg('Copied object %s/%s to %s/%s%s' % (source_bucket, source_name, bucket_name, object_name,
+                                                    cloned and ' sharing extents' or ''))
+        return self._stat_record(bucket_name, object_name, os.stat(_object))
+
+    @defer.inlineCallbacks
+    def copy_object(self, source_bucket, source_name, bucket_name, object_name):
+        _source = yield self.__object_path__(source_bucket, source_name)
+        _object = yield self.__object_path__(bucket_name, object_name)
+        result = yield self._run_in_thread('copy_object', self._copy_object, source_bucket, source_name,
+                                           bucket_name, object_name, _source, _object)
+        defer.returnValue(result)
+
+    def _complete_multipart_upload(self, bucket_name, object_name, _object, upload_id, parts):
+        tmp_path, first_part, first_size = self._assemble_parts(bucket_name, object_name, upload_id, parts)
+        etag = multipart_etag([etag for part_number, etag in parts])
+        try:
+            self._publish_file(bucket_name, object_name, _object, tmp_path, etag)
+        except:
+            if os.path.exists(tmp_path):
+                self._restore_first_part(tmp_path, first_part, first_size)
+            raise
+        shutil.rmtree(self._upload_directory(upload_id), True)
+        log.msg('Completed upload %s of object %s on bucket %s' % (upload_id, object_name, bucket_name))
+        return etag
+
+    @defer.inlineCallbacks
+    def complete_multipart_upload(self, bucket_name, object_name, upload_id, parts):
+        _object = yield self.__object_path__(bucket_name, object_name)
+        result = yield self._run_in_thread('complete_multipart_upload', self._complete_multipart_upload,
+                                           bucket_name, object_name, _object, upload_id, parts)
+        defer.returnValue(result)
+
+    def _abort_multipart_upload(self, bucket_name, object_name, upload_id):
+        self._upload_record(upload_id, bucket_name, object_name)
+        shutil.rmtree(self._upload_directory(upload_id), True)
+        log.msg('Aborted upload %s' % upload_id)
+        return True
+
+    def abort_multipart_upload(self, bucket_name, object_name, upload_id):
+        return self._run('abort_multipart_upload', self._abort_multipart_upload, bucket_name, object_name, upload_id)
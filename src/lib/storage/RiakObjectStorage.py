@@ -1,20 +1,216 @@
-import os
-import sys
 import json
 import time
+import uuid
 import bisect
-import logging
 import datetime
-from txriak import riak
-from cyclone import httpclient
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import defer, protocol
+from twisted.web import client, http, iweb
+from twisted.web.http_headers import Headers
+from zope.interface import implements
+from otto.storage import NoSuchUpload, InvalidPart, BucketNotEmpty, ObjectIterator, multipart_etag
+from otto.storage.riakpool import RiakNodePool, read_body
+from otto.storage.riakgc import RiakGarbageCollector, blob_name
+from otto.storage.riakindex import RiakIndex, LISTING_INDEX, KEY_INDEX, listing_term, _utf8
+
+class LuwakBodyStreamer(protocol.Protocol):
+    def __init__(self, consumer, finished, skip = 0, remaining = None):
+        self.consumer = consumer
+        self.finished = finished
+        self.skip = skip
+        self.remaining = remaining
+
+    def connectionMade(self):
+        # the response transport pauses the luwak socket whenever the client
+        # side consumer asks us to, so we never hold more than a few chunks
+        self.consumer.registerProducer(self.transport, True)
+
+    def dataReceived(self, data):
+        if self.skip:
+            data, self.skip = data[self.skip:], max(self.skip - len(data), 0)
+        if self.remaining is not None:
+            data = data[:self.remaining]
+            self.remaining -= len(data)
+        if data:
+            self.consumer.write(data)
+        if self.remaining == 0:
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        self.consumer.unregisterProducer()
+        if self.remaining == 0 or reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self.finished.callback(True)
+        else:
+            self.finished.errback(reason)
+
+class LuwakUpload(object):
+    implements(iweb.IBodyProducer)
+
+    def __init__(self, length = None):
+        if length is None:
+            length = iweb.UNKNOWN_LENGTH
+        self.length = length
+        self.finished = defer.Deferred()
+        self._consumer = None
+        self._paused = False
+        self._failure = None
+        self._waiting = []
+
+    def startProducing(self, consumer):
+        self._consumer = consumer
+        self._wakeup()
+        return self.finished
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._wakeup()
+
+    def stopProducing(self):
+        self.fail(Exception('Luwak upload stopped by the transport'))
+
+    def fail(self, failure):
+        self._failure = failure
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(failure)
+        return failure
+
+    def _wakeup(self):
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def _ready(self):
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if self._consumer is not None and not self._paused:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def write(self, data):
+        d = self._ready()
+        d.addCallback(lambda _: self._consumer.write(data))
+        return d
+
+def _has_blobs(_object):
+    return isinstance(_object, dict) and ('Parts' in _object or 'ObjectPath' in _object)
+
+def _blob_segments(_object):
+    if 'Parts' in _object:
+        return [(str(object_path), size) for object_path, size in _object['Parts']]
+    return [(str(_object['ObjectPath']), _object['Size'])]
+
+class ObjectHandle(object):
+    def __init__(self, storage, segments, stat):
+        self.storage = storage
+        self.segments = segments
+        self.stat = stat
+
+    @defer.inlineCallbacks
+    def stream(self, consumer, offset = 0, length = None):
+        if len(self.segments) == 1:
+            result = yield self._stream_blob(self.segments[0][0], consumer, offset, length)
+            defer.returnValue(result)
+        if length is None:
+            length = self.stat['Size'] - offset
+        position = 0
+        for object_path, size in self.segments:
+            if length <= 0:
+                break
+            if position + size > offset:
+                start = offset - position
+                count = min(size - start, length)
+                yield self._stream_blob(object_path, consumer, start, count)
+                offset += count
+                length -= count
+            position += size
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _stream_blob(self, object_path, consumer, offset = 0, length = None):
+        if length == 0:
+            defer.returnValue(True)
+        headers = Headers()
+        if offset or length is not None:
+            last = '' if length is None else str(offset + length - 1)
+            headers.addRawHeader('Range', 'bytes=%d-%s' % (offset, last))
+        response = yield self.storage.nodes.request('GET', object_path, headers)
+        if response.code not in (200, 206):
+            yield read_body(response)
+            raise Exception('Unexpected status %s from luwak for %s' % (response.code, object_path))
+        # luwak may ignore the range and send the whole blob, trim it here then
+        skip = offset if response.code == 200 else 0
+        finished = defer.Deferred()
+        response.deliverBody(LuwakBodyStreamer(consumer, finished, skip, length))
+        yield finished
+        defer.returnValue(True)
+
+    def close(self):
+        pass
+
+class ObjectWriter(object):
+    def __init__(self, storage, publish, description, size = None):
+        self.storage = storage
+        self.publish = publish
+        self.description = description
+        self.size = 0
+        self.upload = LuwakUpload(size)
+        self.response = storage.nodes.request('POST', 'luwak',
+            Headers({'Content-Type': ['application/unknown']}), self.upload)
+        self.response.addErrback(self.upload.fail)
+
+    def write(self, data):
+        self.size += len(data)
+        return self.upload.write(data)
+
+    @defer.inlineCallbacks
+    def close(self, etag = None):
+        self.upload.finished.callback(None)
+        response = yield self.response
+        yield read_body(response)
+        if response.code not in (201, 204):
+            raise Exception('Unexpected status %s from luwak for %s' % (response.code, self.description))
+        _object = response.headers.getRawHeaders('location')[0]
+        yield self.publish(_object, self.size, etag)
+        defer.returnValue(True)
+
+    def abort(self):
+        if not self.upload.finished.called:
+            self.upload.finished.errback(Exception('Upload of %s aborted' % self.description))
+            self.response.addErrback(lambda failure: None)
 
 class ObjectStorage(object):
     def __init__(self, storage_config = {}):
         log.msg('RiakObjectStorage.ObjectStorage loaded')
-        self.riak_client = riak.RiakClient()
-        self._private = ['luwak_node', 'deleted_files']
+        self.nodes = RiakNodePool(storage_config.get('nodes', '127.0.0.1:8098').split(','),
+                                  storage_config.get('strategy', 'round_robin'),
+                                  int(storage_config.get('max_in_flight', 128)),
+                                  int(storage_config.get('connections_per_node', 16)),
+                                  float(storage_config.get('health_check_interval', 5)))
+        self._private = ['luwak_node', 'luwak_file', 'luwak_tld', 'deleted_objects', 'otto_gc',
+                         'otto_uploads', 'otto_upload_parts', 'otto_buckets', 'otto_blob_refs']
+        self.index = RiakIndex(self.nodes)
+        # listings from secondary index range queries, needs the eleveldb backend
+        self.list_index = storage_config.get('list_index', 'off').lower() in ('on', 'true', 'yes', '1')
+        self.listing_batch_size = int(storage_config.get('listing_batch_size', 1000))
+        self.delete_concurrency = int(storage_config.get('delete_concurrency', 32))
+        self.gc = RiakGarbageCollector(self,
+                                       float(storage_config.get('gc_interval', 60)),
+                                       int(storage_config.get('gc_batch_size', 100)),
+                                       float(storage_config.get('gc_rate', 50)),
+                                       int(storage_config.get('gc_concurrency', 8)),
+                                       float(storage_config.get('gc_grace_period', 60)),
+                                       float(storage_config.get('gc_orphan_interval', 0)),
+                                       storage_config.get('luwak_file_bucket', 'luwak_file'))
+
+    @property
+    def riak_client(self):
+        return self.nodes.riak_client
 
     @defer.inlineCallbacks
     def __object_path__(self, bucket_name, object_name):
@@ -23,34 +219,29 @@ class ObjectStorage(object):
 
     @defer.inlineCallbacks
     def is_bucket(self, bucket_name, object_name = None):
-        _bucket = yield self.riak_client.list_buckets()
-        if (bucket_name in _bucket):
-            if not object_name:
-                bucket = self.riak_client.bucket(bucket_name)
-                obj = yield bucket.get_binary('__CreationDate__')
-                if obj.exists():
-                    log.msg('Found a bucket with name %s' % bucket_name, logLevel=logging.DEBUG)
-                    defer.returnValue(True)
-                defer.returnValue(False)
-
-            bucket = self.riak_client.bucket(bucket_name)
+        bucket = self.riak_client.bucket(bucket_name)
+        if not object_name:
+            obj = yield bucket.get_binary('__CreationDate__')
+        else:
             obj = yield bucket.get_binary("%s/%s" % (bucket_name, object_name))
-            if obj.exists():
-                log.msg('Found a bucket with name %s/%s' % (bucket_name, object_name), logLevel=logging.DEBUG)
-                defer.returnValue(True)
-        defer.returnValue(False)
+        defer.returnValue(bool(obj.exists()))
     
     @defer.inlineCallbacks
     def is_object(self, bucket_name, object_name):
         bucket = self.riak_client.bucket(bucket_name)
         obj = yield bucket.get_binary(object_name)
         if obj.exists():
-            log.msg('Found object %s on bucket %s' % (object_name, bucket_name), logLevel=logging.DEBUG)
             defer.returnValue(obj)
         defer.returnValue(False)
 
     @defer.inlineCallbacks
     def list_buckets(self):
+        if self.list_index:
+            buckets = yield self.index.list_buckets()
+            defer.returnValue([{
+                                    'Name': bucket_name,
+                                    'CreationDate': datetime.datetime.fromtimestamp(float(creation_date)),
+                               } for bucket_name, creation_date in buckets])
         bucket_list = []
         _bucket = yield self.riak_client.list_buckets()
         for bucket in _bucket:
@@ -68,25 +259,55 @@ class ObjectStorage(object):
     @defer.inlineCallbacks
     def create_bucket(self, bucket_name):
         bucket = self.riak_client.bucket(bucket_name)
-        obj = bucket.new_binary('__CreationDate__', str(time.mktime(datetime.datetime.now().timetuple())))
+        creation_date = str(time.mktime(datetime.datetime.now().timetuple()))
+        obj = bucket.new_binary('__CreationDate__', creation_date)
         yield obj.store()
         del(obj)
+        if self.list_index:
+            yield self.index.register_bucket(bucket_name, creation_date)
         log.msg('Created bucket %s' % bucket_name)
+        defer.returnValue(True)
 
     @defer.inlineCallbacks
     def delete_bucket(self, bucket_name):
+        if self.list_index:
+            # the index may miss objects written before reindex ran, only the
+            # keys themselves tell whether the bucket is empty
+            object_names = yield self.riak_client.bucket(bucket_name).list_keys()
+            if [object_name for object_name in object_names if object_name != '__CreationDate__']:
+                raise BucketNotEmpty(bucket_name)
         obj = yield self.delete_object(bucket_name, '__CreationDate__')
+        if self.list_index:
+            yield self.index.unregister_bucket(bucket_name)
         if obj:
             log.msg('Removed bucket %s' % bucket_name)
             defer.returnValue(True)
         defer.returnValue(False)
 
+    def iter_objects(self, bucket_name, marker = None, prefix = None, max_keys = 5000, terse = None):
+        batch_size = self.list_index and self.listing_batch_size or max_keys
+        return ObjectIterator(self.list_objects, bucket_name, marker, prefix, max_keys, terse, batch_size)
+
     @defer.inlineCallbacks
     def list_objects(self, bucket_name, marker = None, prefix = None, max_keys = 5000, terse = None):
+        if self.list_index:
+            contents, truncated = yield self.index.list_objects(bucket_name, marker, prefix, max_keys)
+            if terse:
+                contents = [{'Key': content['Key']} for content in contents]
+            defer.returnValue({
+                        'Name': bucket_name,
+                        'Prefix': prefix,
+                        'Marker': contents and contents[-1]['Key'] or marker,
+                        'MaxKeys': max_keys,
+                        'IsTruncated': truncated,
+                        'Contents': contents
+                    })
         start_pos = 0
         truncated = False
         bucket = self.riak_client.bucket(bucket_name)
-        objects = yield bucket.list_keys()
+        # riak hands keys back in no particular order
+        objects = sorted((yield bucket.list_keys()))
+        marker, prefix = _utf8(marker), _utf8(prefix or '')
         if marker:
             start_pos = bisect.bisect_right(objects, marker, start_pos)
         if prefix:
@@ -108,7 +329,6 @@ class ObjectStorage(object):
                         'Size': _stat['Size'],
                     })
                 contents.append(content)
-                log.msg('Listing object %s from bucket %s' % (_object, bucket_name))
                 marker = _object
 
         defer.returnValue({ 
@@ -120,82 +340,293 @@ class ObjectStorage(object):
                     'Contents': contents
                 })
 
+    def _stat_record(self, _object):
+        _stat = {
+                    'LastModified': datetime.datetime.fromtimestamp(float(_object['LastModified'])),
+                    'CreationDate': datetime.datetime.fromtimestamp(float(_object['CreationDate'])),
+                    'Size': _object['Size']
+                }
+        if _object.get('ETag'):
+            _stat['ETag'] = _object['ETag']
+        return _stat
+
     @defer.inlineCallbacks
     def stat_object(self, bucket_name, object_name):
         bucket = self.riak_client.bucket(bucket_name)
         _object = yield bucket.get_binary(object_name)
         if _object.exists():
-            log.msg('Stating object %s fron bucket %s' % (object_name, bucket_name))
             _object = json.loads(_object.get_data())
-            log.msg(_object)
-            _stat =  yield {
-                                'LastModified': datetime.datetime.fromtimestamp(float(_object['LastModified'])),
-                                'CreationDate': datetime.datetime.fromtimestamp(float(_object['CreationDate'])),
-                                'Size': _object['Size']
-                           }
+            _stat = yield self._stat_record(_object)
             defer.returnValue(_stat)
         defer.returnValue(False)
 
+    @defer.inlineCallbacks
+    def open_object(self, bucket_name, object_name):
+        bucket = self.riak_client.bucket(bucket_name)
+        _object = yield bucket.get_binary(object_name)
+        if not _object.exists():
+            defer.returnValue(None)
+        _object = json.loads(_object.get_data())
+        defer.returnValue(ObjectHandle(self, _blob_segments(_object), self._stat_record(_object)))
+
     @defer.inlineCallbacks
     def read_object(self, bucket_name, object_name):
         bucket = self.riak_client.bucket(bucket_name)
         _object = yield bucket.get_binary(object_name)
         _object = json.loads(_object.get_data())
-        content = yield httpclient.fetch('http://127.0.0.1:8098/%s' % _object['ObjectPath'])
-        defer.returnValue(content.body)
+        content = []
+        for object_path, size in _blob_segments(_object):
+            response, data = yield self.nodes.fetch('GET', object_path)
+            content.append(data)
+        defer.returnValue(''.join(content))
+
+    @defer.inlineCallbacks
+    def stream_object(self, bucket_name, object_name, consumer, offset = 0, length = None):
+        handle = yield self.open_object(bucket_name, object_name)
+        result = yield handle.stream(consumer, offset, length)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def open_object_writer(self, bucket_name, object_name, size = None, etag = None):
+        writer = yield ObjectWriter(self,
+            lambda object_path, size, etag: self._publish_object(bucket_name, object_name, [(object_path, size)], size, etag),
+            '%s/%s' % (bucket_name, object_name), size)
+        defer.returnValue(writer)
+
+    @defer.inlineCallbacks
+    def write_object(self, bucket_name, object_name, content, etag = None):
+        writer = yield self.open_object_writer(bucket_name, object_name, len(content), etag)
+        try:
+            yield writer.write(content)
+        except:
+            writer.abort()
+            raise
+        yield writer.close(etag)
+        defer.returnValue(True)
 
     @defer.inlineCallbacks
-    def write_object(self, bucket_name, object_name, content):
-        _object = yield self.__object_path__(bucket_name, object_name)
+    def _publish_object(self, bucket_name, object_name, segments, size, etag = None):
         _stat_obj = yield self.is_object(bucket_name, object_name)
         creation_date = None
         if _stat_obj:
             _stat_obj = json.loads(_stat_obj.get_data())
             creation_date = _stat_obj['CreationDate']
 
-        status = yield httpclient.fetch('http://127.0.0.1:8098/luwak', method="POST", postdata=content, headers={"Content-Type": ["application/unknown"]})
-        log.msg('Response Headers from luwak %s' % status.headers)
-        log.msg('Response Body from luwak %s' % status.body)
-        log.msg('Status Code from luwak %s' % status.code)
-        log.msg('Status Length from luwak %s' % status.length)
-        _object = status.headers['Location'][0] 
-        log.msg('Object location on luwak %s' % _object)
         stat = { 
                     'CreationDate': creation_date or str(time.mktime(datetime.datetime.now().timetuple())),
                     'LastModified': str(time.mktime(datetime.datetime.now().timetuple())),
-                    'ObjectPath': _object,
-                    'Size': sys.getsizeof(content)
+                    'Size': size,
+                    'ETag': etag
                }
-        bucket = self.riak_client.bucket(bucket_name)
-        obj = bucket.new_binary(object_name, json.dumps(stat))
-        yield obj.store()
-        del(obj)
-        log.msg('Created object %s on bucket %s' % (object_name, bucket_name))
+        if len(segments) == 1:
+            stat['ObjectPath'] = segments[0][0]
+        else:
+            stat['Parts'] = segments
+        yield self._store_record(bucket_name, object_name, stat)
         if _stat_obj:
-            bucket = self.riak_client.bucket('deleted_objects')
-            stat = {
-                        'DeletetionDate': creation_date or str(time.mktime(datetime.datetime.now().timetuple())),
-                        'ObjectPath': _stat_obj['ObjectPath'].split('/')[-1],
-                        'FromBucket': bucket_name
-                   }
-            log.msg('Old object location from bucket %s in luwak %s' % (bucket_name, _stat_obj['ObjectPath']))
-            obj = bucket.new_binary(_stat_obj['ObjectPath'].split('/')[-1], json.dumps(stat))
-            yield obj.store()
-            del(obj)   
-            status = yield httpclient.fetch('http://127.0.0.1:8098/%s' % _stat_obj['ObjectPath'], method="DELETE")
+            kept = set(blob_name(object_path) for object_path, _ in segments)
+            yield self.gc.retire([object_path for object_path, _ in _blob_segments(_stat_obj)
+                                  if blob_name(object_path) not in kept], bucket_name, object_name)
         defer.returnValue(True)
 
+    @defer.inlineCallbacks
+    def _store_record(self, bucket_name, object_name, record):
+        if self.list_index:
+            yield self.index.store(bucket_name, object_name, json.dumps(record), {
+                    LISTING_INDEX: listing_term(object_name, record['Size'], record['LastModified'], record.get('ETag'))})
+        else:
+            obj = self.riak_client.bucket(bucket_name).new_binary(object_name, json.dumps(record))
+            yield obj.store()
+
+    @defer.inlineCallbacks
+    def copy_object(self, source_bucket, source_name, bucket_name, object_name):
+        obj = yield self.riak_client.bucket(source_bucket).get_binary(source_name)
+        if not obj.exists():
+            defer.returnValue(None)
+        _object = json.loads(obj.get_data())
+        segments = _blob_segments(_object)
+        # the collector has to know both objects point at the blobs before either goes away
+        yield self.gc.share([object_path for object_path, _ in segments],
+                            [(source_bucket, source_name), (bucket_name, object_name)])
+        yield self._publish_object(bucket_name, object_name, segments, _object['Size'], _object.get('ETag'))
+        log.msg('Copied object %s/%s to %s/%s sharing %d luwak blobs' % (source_bucket, source_name,
+                                                                        bucket_name, object_name, len(segments)))
+        result = yield self.stat_object(bucket_name, object_name)
+        defer.returnValue(result)
+
+    def _blob_referenced(self, _object, object_path):
+        if not _has_blobs(_object):
+            return False
+        return blob_name(object_path) in set(blob_name(path) for path, _ in _blob_segments(_object))
+
+    @defer.inlineCallbacks
+    def _referenced_blobs(self):
+        referenced = set()
+        buckets = yield self.riak_client.list_buckets()
+        for bucket_name in buckets:
+            if bucket_name in self._private and bucket_name != 'otto_upload_parts':
+                continue
+            bucket = self.riak_client.bucket(bucket_name)
+            for object_name in (yield bucket.list_keys()):
+                obj = yield bucket.get_binary(object_name)
+                if not obj.exists():
+                    continue
+                try:
+                    _object = json.loads(obj.get_data())
+                except ValueError:
+                    continue
+                if _has_blobs(_object):
+                    referenced.update(blob_name(object_path) for object_path, _ in _blob_segments(_object))
+        defer.returnValue(referenced)
+
     @defer.inlineCallbacks
     def delete_object(self, bucket_name, object_name):
         bucket = self.riak_client.bucket(bucket_name)
         obj = yield bucket.get_binary(object_name)
         if obj.exists():
             _object = json.loads(obj.get_data())
-            if 'ObjectPath' in object_name: 
-                httpclient.fetch('http://127.0.0.1:8098/%s' % _object['ObjectPath'], method="DELETE")
-                log.msg('Deleted object %s from bucket %s on %s' % (object_name, bucket_name, _object['ObjectPath']))
-            else:
-                log.msg('Deleted object %s from bucket %s' % (object_name, bucket_name))
-            obj.delete()
+            yield obj.delete()
+            if _has_blobs(_object):
+                yield self.gc.retire([object_path for object_path, _ in _blob_segments(_object)], bucket_name, object_name)
             defer.returnValue(True)
         defer.returnValue(False)
+
+    def _delete_one(self, bucket_name, object_name):
+        d = self.delete_object(bucket_name, object_name)
+        d.addCallbacks(lambda _: (object_name, None),
+                       lambda failure: (object_name, failure.getErrorMessage()))
+        return d
+
+    def delete_objects(self, bucket_name, object_names):
+        semaphore = defer.DeferredSemaphore(self.delete_concurrency)
+        return defer.gatherResults([semaphore.run(self._delete_one, bucket_name, object_name)
+                                    for object_name in object_names])
+
+    @defer.inlineCallbacks
+    def _key_range(self, bucket_name, start, end, max_results = None, continuation = None):
+        """Returns (keys, continuation) of one page of the keys between start
+        and end, both included. $key queries need a backend with secondary
+        indexes, so without list_index the whole range comes from a key fold"""
+        if self.list_index:
+            results, continuation = yield self.index.query(bucket_name, KEY_INDEX, start, end,
+                                                           max_results, continuation)
+            defer.returnValue(([key for _, key in results], continuation))
+        keys = yield self.riak_client.bucket(bucket_name).list_keys()
+        defer.returnValue((sorted(key for key in keys if start <= key <= end), None))
+
+    @defer.inlineCallbacks
+    def _upload_record(self, upload_id, bucket_name = None, object_name = None):
+        bucket = self.riak_client.bucket('otto_uploads')
+        obj = yield bucket.get_binary(upload_id)
+        if not obj.exists():
+            raise NoSuchUpload(upload_id)
+        record = json.loads(obj.get_data())
+        if bucket_name is not None and (_utf8(record['Bucket']) != _utf8(bucket_name) or
+                                        _utf8(record['Key']) != _utf8(object_name)):
+            raise NoSuchUpload(upload_id)
+        defer.returnValue(record)
+
+    @defer.inlineCallbacks
+    def create_multipart_upload(self, bucket_name, object_name):
+        upload_id = uuid.uuid4().hex
+        bucket = self.riak_client.bucket('otto_uploads')
+        obj = bucket.new_binary(upload_id, json.dumps({
+                                                        'Bucket': bucket_name,
+                                                        'Key': object_name,
+                                                        'Initiated': str(time.time())
+                                                      }))
+        yield obj.store()
+        log.msg('Initiated upload %s of object %s on bucket %s' % (upload_id, object_name, bucket_name))
+        defer.returnValue(upload_id)
+
+    @defer.inlineCallbacks
+    def _publish_part(self, upload_id, part_number, object_path, size, etag):
+        bucket = self.riak_client.bucket('otto_upload_parts')
+        part_name = '%s:%05d' % (upload_id, part_number)
+        old = yield bucket.get_binary(part_name)
+        obj = bucket.new_binary(part_name, json.dumps({
+                                                        'ObjectPath': object_path,
+                                                        'Size': size,
+                                                        'ETag': etag,
+                                                        'LastModified': str(time.time())
+                                                      }))
+        yield obj.store()
+        if old.exists():
+            yield self.gc.retire([json.loads(old.get_data())['ObjectPath']], 'otto_upload_parts', part_name)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def open_part_writer(self, bucket_name, object_name, upload_id, part_number, size = None):
+        yield self._upload_record(upload_id, bucket_name, object_name)
+        writer = ObjectWriter(self,
+            lambda object_path, size, etag: self._publish_part(upload_id, part_number, object_path, size, etag),
+            'part %d of upload %s' % (part_number, upload_id), size)
+        defer.returnValue(writer)
+
+    @defer.inlineCallbacks
+    def _part_records(self, upload_id):
+        bucket = self.riak_client.bucket('otto_upload_parts')
+        parts = []
+        continuation = None
+        while True:
+            # part names run from upload_id:00001 to upload_id:10000
+            part_names, continuation = yield self._key_range('otto_upload_parts', '%s:' % upload_id,
+                                                             '%s:99999' % upload_id, 1000, continuation)
+            for part_name in part_names:
+                obj = yield bucket.get_binary(part_name)
+                if obj.exists():
+                    parts.append((int(part_name.split(':')[-1]), json.loads(obj.get_data())))
+            if not continuation:
+                break
+        defer.returnValue(parts)
+
+    @defer.inlineCallbacks
+    def list_parts(self, bucket_name, object_name, upload_id):
+        record = yield self._upload_record(upload_id, bucket_name, object_name)
+        parts = yield self._part_records(upload_id)
+        defer.returnValue((record, [{
+                                        'PartNumber': part_number,
+                                        'ETag': part['ETag'],
+                                        'Size': part['Size'],
+                                        'LastModified': datetime.datetime.fromtimestamp(float(part['LastModified']))
+                                    } for part_number, part in parts]))
+
+    @defer.inlineCallbacks
+    def complete_multipart_upload(self, bucket_name, object_name, upload_id, parts):
+        yield self._upload_record(upload_id, bucket_name, object_name)
+        bucket = self.riak_client.bucket('otto_upload_parts')
+        segments = []
+        for part_number, etag in parts:
+            obj = yield bucket.get_binary('%s:%05d' % (upload_id, part_number))
+            if not obj.exists():
+                raise InvalidPart('Part %d of upload %s was never uploaded' % (part_number, upload_id))
+            part = json.loads(obj.get_data())
+            if part['ETag'] != etag:
+                raise InvalidPart('Part %d of upload %s has ETag %s, not %s' % (part_number, upload_id, part['ETag'], etag))
+            segments.append((part['ObjectPath'], part['Size']))
+
+        etag = multipart_etag([etag for part_number, etag in parts])
+        yield self._publish_object(bucket_name, object_name, segments, sum(size for _, size in segments), etag)
+        used = set(object_path for object_path, _ in segments)
+        for part_number, part in (yield self._part_records(upload_id)):
+            obj = yield bucket.get_binary('%s:%05d' % (upload_id, part_number))
+            yield obj.delete()
+            if part['ObjectPath'] not in used:
+                yield self.gc.retire([part['ObjectPath']], 'otto_upload_parts', '%s:%05d' % (upload_id, part_number))
+        obj = yield self.riak_client.bucket('otto_uploads').get_binary(upload_id)
+        yield obj.delete()
+        log.msg('Completed upload %s of object %s on bucket %s' % (upload_id, object_name, bucket_name))
+        defer.returnValue(etag)
+
+    @defer.inlineCallbacks
+    def abort_multipart_upload(self, bucket_name, object_name, upload_id):
+        yield self._upload_record(upload_id, bucket_name, object_name)
+        bucket = self.riak_client.bucket('otto_upload_parts')
+        for part_number, part in (yield self._part_records(upload_id)):
+            obj = yield bucket.get_binary('%s:%05d' % (upload_id, part_number))
+            yield obj.delete()
+            yield self.gc.retire([part['ObjectPath']], 'otto_upload_parts', '%s:%05d' % (upload_id, part_number))
+        obj = yield self.riak_client.bucket('otto_uploads').get_binary(upload_id)
+        yield obj.delete()
+        log.msg('Aborted upload %s' % upload_id)
+        defer.returnValue(True)
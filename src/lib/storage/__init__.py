@@ -0,0 +1,69 @@
+import binascii
+from hashlib import md5
+from cyclone import web
+from twisted.internet import defer
+
+class StorageBusy(web.HTTPError):
+    def __init__(self, log_message = None):
+        web.HTTPError.__init__(self, 503, log_message)
+
+class NoSuchUpload(web.HTTPError):
+    def __init__(self, upload_id = None):
+        web.HTTPError.__init__(self, 404, 'No such upload %s' % upload_id)
+
+class InvalidPart(web.HTTPError):
+    def __init__(self, log_message = None):
+        web.HTTPError.__init__(self, 400, log_message)
+
+class BadDigest(web.HTTPError):
+    def __init__(self, log_message = None):
+        web.HTTPError.__init__(self, 400, log_message)
+
+class BucketNotEmpty(web.HTTPError):
+    def __init__(self, bucket_name = None):
+        web.HTTPError.__init__(self, 403, 'Bucket %s is not empty' % bucket_name)
+
+class InvalidName(web.HTTPError):
+    def __init__(self, log_message = None):
+        web.HTTPError.__init__(self, 400, log_message)
+
+def valid_bucket_name(bucket_name, reserved = ()):
+    """Dot names are where the backends keep their own state, reserved ones too"""
+    return bool(bucket_name) and not bucket_name.startswith('.') and '/' not in bucket_name \
+        and bucket_name not in reserved
+
+def multipart_etag(etags):
+    digest = md5(''.join(binascii.unhexlify(etag) for etag in etags))
+    return '%s-%d' % (digest.hexdigest(), len(etags))
+
+class ObjectIterator(object):
+    def __init__(self, list_objects, bucket_name, marker = None, prefix = None, max_keys = 5000,
+                 terse = None, batch_size = 1000):
+        self.list_objects = list_objects
+        self.bucket_name = bucket_name
+        self.marker = marker
+        self.prefix = prefix
+        self.remaining = max_keys
+        self.terse = terse
+        self.batch_size = batch_size
+        self.truncated = False
+        self.next_marker = None
+        self.done = max_keys <= 0
+
+    @defer.inlineCallbacks
+    def next_batch(self):
+        if self.done:
+            defer.returnValue([])
+        page = yield self.list_objects(self.bucket_name, self.marker, self.prefix,
+                                       min(self.batch_size, self.remaining), self.terse)
+        contents = page['Contents']
+        self.remaining -= len(contents)
+        if contents:
+            self.marker = contents[-1]['Key']
+        if not page['IsTruncated'] or not contents:
+            self.done = True
+        elif self.remaining <= 0:
+            self.done = True
+            self.truncated = True
+            self.next_marker = self.marker
+        defer.returnValue(contents)
@@ -0,0 +1,87 @@
+"""Moves an FsObjectStorage tree from one layout to another.
+
+Stop otto first, then:
+
+    $ python -m otto.storage.fsmigrate /tmp/otto sharded --depth 2 --width 2
+    $ python -m otto.storage.fsmigrate /tmp/otto flat
+
+Objects are renamed in place, so their mtime and the bucket indexes stay
+valid. An interrupted run leaves the tree marked as migrating, which otto
+refuses to serve, and picks up where it stopped when run again.
+"""
+import os
+import sys
+from optparse import OptionParser
+from otto.storage.FsObjectStorage import BucketIndex, parse_layout
+
+def _marker(directory):
+    return os.path.join(directory, '.otto', 'layout')
+
+def read_layout(directory):
+    try:
+        return open(_marker(directory)).read().strip()
+    except IOError:
+        return 'flat'
+
+def _prune(bucket_path):
+    for root, dirs, files in os.walk(bucket_path, topdown=False):
+        if root != bucket_path and not files and not os.listdir(root):
+            os.rmdir(root)
+
+def migrate_bucket(directory, bucket_name, source, target, dry_run = False):
+    bucket_path = os.path.abspath(os.path.join(directory, bucket_name))
+    index = BucketIndex(os.path.join(directory, '.otto', 'index', '%s.db' % bucket_name))
+    if not index.is_complete():
+        index.rebuild(bucket_path, source)
+    moved = 0
+    for key in index.keys():
+        _source = source.object_path(bucket_path, key)
+        _target = target.object_path(bucket_path, key)
+        if _source == _target or not os.path.isfile(_source):
+            continue
+        moved += 1
+        if dry_run:
+            continue
+        _directory = os.path.dirname(_target)
+        if not os.path.isdir(_directory):
+            os.makedirs(_directory)
+        os.rename(_source, _target)
+        target.record_key(_target, key)
+        source.forget_key(_source)
+    index.close()
+    if not dry_run:
+        _prune(bucket_path)
+    return moved
+
+def migrate(directory, layout, dry_run = False):
+    current = read_layout(directory)
+    if current.startswith('migrating '):
+        current = current[len('migrating '):].split(' -> ')[0]
+    source, target = parse_layout(current), parse_layout(layout)
+    if str(source) == str(target):
+        print '%s already uses the %s layout' % (directory, target)
+        return 0
+    if not dry_run:
+        open(_marker(directory), 'w').write('migrating %s -> %s' % (source, target))
+    total = 0
+    for bucket_name in sorted(os.listdir(directory)):
+        if bucket_name.startswith('.') or not os.path.isdir(os.path.join(directory, bucket_name)):
+            continue
+        moved = migrate_bucket(directory, bucket_name, source, target, dry_run)
+        print '%s: %s %d objects' % (bucket_name, dry_run and 'would move' or 'moved', moved)
+        total += moved
+    if not dry_run:
+        open(_marker(directory), 'w').write(str(target))
+    print '%s: %s -> %s, %d objects' % (directory, source, target, total)
+    return total
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog directory flat|sharded [options]')
+    parser.add_option('--depth', type='int', default=2, help='shard directory levels [%default]')
+    parser.add_option('--width', type='int', default=2, help='hex digits per shard level [%default]')
+    parser.add_option('-n', '--dry-run', action='store_true', help='only count the objects to move')
+    options, args = parser.parse_args()
+    if len(args) != 2 or args[1] not in ('flat', 'sharded'):
+        parser.error('need a directory and a target layout')
+    layout = args[1] == 'sharded' and 'sharded %d %d' % (options.depth, options.width) or 'flat'
+    migrate(args[0], layout, options.dry_run)
@@ -0,0 +1,251 @@
+import json
+import time
+import binascii
+from twisted.python import log
+from twisted.internet import defer, reactor, task
+from otto.storage.riakindex import _utf8
+
+LEDGER_BUCKET = 'deleted_objects'
+PROGRESS_BUCKET = 'otto_gc'
+# one entry per object sharing a blob with another after a server side copy,
+# keyed blob name.hex(bucket/key)
+REFS_BUCKET = 'otto_blob_refs'
+FIRST_KEY, LAST_KEY = '\x00', '\xff'
+
+def blob_name(object_path):
+    return str(object_path).rstrip('/').split('/')[-1]
+
+def _blob_path(object_path):
+    object_path = str(object_path)
+    if '/' not in object_path:
+        # ledger entries written before the collector existed only kept the blob name
+        object_path = 'luwak/%s' % object_path
+    return object_path
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = rate > 0 and 1.0 / rate or 0
+        self.next_slot = 0
+
+    def acquire(self):
+        now = time.time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot <= now:
+            return defer.succeed(None)
+        return task.deferLater(reactor, slot - now, lambda: None)
+
+class RiakGarbageCollector(object):
+    """Reclaims luwak blobs that were retired to the deleted_objects ledger.
+
+    Entries are only reclaimed once they are older than the grace period, so
+    GETs already streaming the old blob can finish, and only if the owning
+    metadata record no longer points at the blob, nor any other object the
+    blob was shared with by a copy.
+    """
+    def __init__(self, storage, interval = 60, batch_size = 100, rate = 50, concurrency = 8,
+                 grace_period = 60, orphan_interval = 0, luwak_bucket = 'luwak_file'):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.grace_period = grace_period
+        self.luwak_bucket = luwak_bucket
+        self.limiter = RateLimiter(rate)
+        self.semaphore = defer.DeferredSemaphore(max(1, concurrency))
+        self.cursor = None
+        self.running = False
+        self.suspects = None
+        self.metrics = {
+                            'sweeps': 0,
+                            'scanned': 0,
+                            'reclaimed': 0,
+                            'referenced': 0,
+                            'deferred': 0,
+                            'errors': 0,
+                            'orphans': 0,
+                            'pending': 0,
+                            'last_sweep': None,
+                            'last_duration': 0.0,
+                       }
+        self.sweeper = task.LoopingCall(self.sweep)
+        self.orphan_sweeper = task.LoopingCall(self.sweep_orphans)
+        if interval > 0:
+            reactor.callWhenRunning(self.sweeper.start, interval, now=False)
+        if orphan_interval > 0:
+            reactor.callWhenRunning(self.orphan_sweeper.start, orphan_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        log.msg('Riak garbage collector sweeping every %ss, %d entries per batch' % (interval, batch_size))
+
+    def stop(self):
+        for loop in (self.sweeper, self.orphan_sweeper):
+            if loop.running:
+                loop.stop()
+
+    def stats(self):
+        return dict(self.metrics, cursor=self.cursor)
+
+    @defer.inlineCallbacks
+    def retire(self, object_paths, bucket_name = None, object_name = None):
+        bucket = self.storage.riak_client.bucket(LEDGER_BUCKET)
+        for object_path in object_paths:
+            entry = {
+                        'DeletionDate': str(time.time()),
+                        'ObjectPath': str(object_path),
+                        'FromBucket': bucket_name,
+                        'Key': object_name,
+                    }
+            obj = bucket.new_binary(blob_name(object_path), json.dumps(entry))
+            yield obj.store()
+
+    @defer.inlineCallbacks
+    def share(self, object_paths, owners):
+        """Records that every (bucket, key) in owners may point at the blobs"""
+        for object_path in object_paths:
+            name = blob_name(object_path)
+            for bucket_name, object_name in owners:
+                entry = json.dumps({'Bucket': bucket_name, 'Key': object_name, 'ObjectPath': str(object_path)})
+                ref_key = '%s.%s' % (name, binascii.hexlify('%s/%s' % (_utf8(bucket_name), _utf8(object_name))))
+                obj = self.storage.riak_client.bucket(REFS_BUCKET).new_binary(ref_key, entry)
+                yield obj.store()
+
+    def _keys(self, bucket_name, start, end, continuation = None):
+        """Returns (keys, continuation) of one page of the keys between start
+        and end, both included"""
+        return self.storage._key_range(bucket_name, start, end, self.batch_size, continuation)
+
+    @defer.inlineCallbacks
+    def _sharers(self, object_path):
+        name = blob_name(object_path)
+        ref_keys = []
+        continuation = None
+        while True:
+            # hex digits all sort below 'g'
+            keys, continuation = yield self._keys(REFS_BUCKET, name + '.', name + '.g', continuation)
+            ref_keys.extend(keys)
+            if not continuation:
+                break
+        defer.returnValue(ref_keys)
+
+    @defer.inlineCallbacks
+    def _load_progress(self):
+        obj = yield self.storage.riak_client.bucket(PROGRESS_BUCKET).get_binary('progress')
+        if obj.exists():
+            self.cursor = json.loads(obj.get_data()).get('cursor')
+
+    @defer.inlineCallbacks
+    def _save_progress(self):
+        obj = self.storage.riak_client.bucket(PROGRESS_BUCKET).new_binary('progress', json.dumps({
+                                                                            'cursor': self.cursor,
+                                                                            'updated': str(time.time())
+                                                                          }))
+        yield obj.store()
+
+    @defer.inlineCallbacks
+    def _owner_references(self, bucket_name, object_name, object_path):
+        if not bucket_name or not object_name:
+            defer.returnValue(False)
+        obj = yield self.storage.riak_client.bucket(bucket_name).get_binary(object_name)
+        if not obj.exists():
+            defer.returnValue(False)
+        defer.returnValue(self.storage._blob_referenced(json.loads(obj.get_data()), object_path))
+
+    @defer.inlineCallbacks
+    def _is_referenced(self, entry, object_path):
+        referenced = yield self._owner_references(entry.get('FromBucket'), entry.get('Key'), object_path)
+        if referenced:
+            defer.returnValue(True)
+        bucket = self.storage.riak_client.bucket(REFS_BUCKET)
+        for ref_key in (yield self._sharers(object_path)):
+            obj = yield bucket.get_binary(ref_key)
+            if not obj.exists():
+                continue
+            ref = json.loads(obj.get_data())
+            referenced = yield self._owner_references(ref['Bucket'], ref['Key'], object_path)
+            if referenced:
+                defer.returnValue(True)
+            yield obj.delete()
+        defer.returnValue(False)
+
+    @defer.inlineCallbacks
+    def _collect(self, ledger_key):
+        bucket = self.storage.riak_client.bucket(LEDGER_BUCKET)
+        obj = yield bucket.get_binary(ledger_key)
+        if not obj.exists():
+            defer.returnValue(None)
+        entry = json.loads(obj.get_data())
+        if float(entry.get('DeletionDate') or entry.get('DeletetionDate') or 0) + self.grace_period > time.time():
+            self.metrics['deferred'] += 1
+            defer.returnValue(None)
+        object_path = _blob_path(entry['ObjectPath'])
+        referenced = yield self._is_referenced(entry, object_path)
+        if referenced:
+            self.metrics['referenced'] += 1
+        else:
+            yield self.limiter.acquire()
+            response, _ = yield self.storage.nodes.fetch('DELETE', object_path)
+            if response.code not in (204, 404):
+                raise Exception('Unexpected status %s from luwak deleting %s' % (response.code, object_path))
+            self.metrics['reclaimed'] += 1
+        yield obj.delete()
+
+    def _collect_safely(self, ledger_key):
+        d = self._collect(ledger_key)
+        def failed(failure):
+            self.metrics['errors'] += 1
+            log.msg('Garbage collection of %s failed: %s' % (ledger_key, failure.getErrorMessage()))
+        return d.addErrback(failed)
+
+    @defer.inlineCallbacks
+    def sweep(self):
+        if self.running:
+            defer.returnValue(None)
+        self.running = True
+        started = time.time()
+        try:
+            if self.cursor is None:
+                yield self._load_progress()
+            # page through the ledger from the cursor, a batch per query
+            start = self.cursor or FIRST_KEY
+            seen = 0
+            continuation = None
+            while True:
+                keys, continuation = yield self._keys(LEDGER_BUCKET, start, LAST_KEY, continuation)
+                seen += len(keys)
+                batch = [key for key in keys if key > start]
+                if batch:
+                    yield defer.gatherResults([self.semaphore.run(self._collect_safely, key) for key in batch])
+                    self.metrics['scanned'] += len(batch)
+                    self.cursor = batch[-1]
+                    yield self._save_progress()
+                if not continuation:
+                    break
+            self.metrics['pending'] = seen
+            # start over from the beginning of the ledger on the next sweep
+            self.cursor = ''
+            yield self._save_progress()
+        except Exception, e:
+            self.metrics['errors'] += 1
+            log.msg('Garbage collection sweep failed: %s' % e)
+        finally:
+            self.running = False
+            self.metrics['sweeps'] += 1
+            self.metrics['last_sweep'] = started
+            self.metrics['last_duration'] = time.time() - started
+        log.msg('Garbage collection sweep reclaimed %(reclaimed)d blobs so far, %(pending)d ledger entries seen' % self.metrics)
+
+    @defer.inlineCallbacks
+    def sweep_orphans(self):
+        """Retires blobs no metadata record points at.
+
+        A blob is only retired when two consecutive sweeps found it
+        unreferenced, which leaves uploads still in flight alone.
+        """
+        referenced = yield self.storage._referenced_blobs()
+        blobs = yield self.storage.riak_client.bucket(self.luwak_bucket).list_keys()
+        unreferenced = set(blobs) - referenced
+        if self.suspects is not None:
+            orphans = sorted(unreferenced & self.suspects)
+            if orphans:
+                yield self.retire(['luwak/%s' % orphan for orphan in orphans])
+                self.metrics['orphans'] += len(orphans)
+                log.msg('Retired %d orphaned luwak blobs' % len(orphans))
+        self.suspects = unreferenced
@@ -0,0 +1,173 @@
+import json
+import urllib
+import binascii
+import datetime
+from optparse import OptionParser
+from StringIO import StringIO
+from twisted.python import log
+from twisted.internet import defer
+from twisted.web import client
+from twisted.web.http_headers import Headers
+
+LISTING_INDEX = 'otto_list_bin'
+BUCKET_INDEX = 'otto_bucket_bin'
+REGISTRY_BUCKET = 'otto_buckets'
+# riak's builtin index of every key, pages through a bucket without a key fold
+KEY_INDEX = '$key'
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+# Index terms are hex(key).size.mtime.etag. Hex keeps the byte order of the
+# keys and '.' sorts below every hex digit, so a key sorts before the keys it
+# is a prefix of, just like the plain keys do.
+
+def listing_term(object_name, size, last_modified, etag = None):
+    return '%s.%d.%s.%s' % (binascii.hexlify(_utf8(object_name)), int(size), last_modified, etag or '')
+
+def parse_listing_term(term):
+    key, size, rest = str(term).split('.', 2)
+    last_modified, _, etag = rest.rpartition('.')
+    return binascii.unhexlify(key), int(size), last_modified, etag or None
+
+def bucket_term(bucket_name, creation_date):
+    return '%s.%s' % (binascii.hexlify(_utf8(bucket_name)), creation_date)
+
+def parse_bucket_term(term):
+    name, _, creation_date = str(term).partition('.')
+    return binascii.unhexlify(name), creation_date
+
+def term_range(marker = None, prefix = None):
+    """Smallest and largest term of the keys after marker starting with prefix"""
+    start = prefix and binascii.hexlify(_utf8(prefix)) or '0'
+    if marker:
+        # '/' sorts between '.' and '0': past the marker, before anything longer
+        start = max(start, binascii.hexlify(_utf8(marker)) + '/')
+    end = (prefix and binascii.hexlify(_utf8(prefix)) or '') + 'g'
+    return start, end
+
+def object_url(bucket_name, object_name):
+    return 'riak/%s/%s' % (urllib.quote(_utf8(bucket_name), safe=''), urllib.quote(_utf8(object_name), safe=''))
+
+class RiakIndex(object):
+    """Reads and writes the secondary index terms otto lists objects and
+    buckets from, so a listing page is a single 2i range query instead of a
+    key fold over the whole cluster. Needs the eleveldb riak backend."""
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    @defer.inlineCallbacks
+    def store(self, bucket_name, object_name, data, indexes):
+        """Stores a JSON record with its index terms"""
+        headers = Headers({'Content-Type': ['application/json']})
+        for index, term in indexes.items():
+            headers.addRawHeader('X-Riak-Index-%s' % index, term)
+        response, body = yield self.nodes.fetch('PUT', object_url(bucket_name, object_name), headers,
+                                                client.FileBodyProducer(StringIO(data)))
+        if response.code not in (200, 204):
+            raise Exception('Unexpected status %s from riak storing %s/%s' % (response.code, bucket_name, object_name))
+
+    @defer.inlineCallbacks
+    def query(self, bucket_name, index, start, end, max_results = None, continuation = None):
+        """Returns ([(term, key)], continuation) of one page of a range query"""
+        arguments = {'return_terms': 'true'}
+        if max_results:
+            arguments['max_results'] = str(max_results)
+        if continuation:
+            arguments['continuation'] = continuation
+        response, body = yield self.nodes.fetch('GET', 'buckets/%s/index/%s/%s/%s?%s' % (
+                                                    urllib.quote(_utf8(bucket_name), safe=''), index,
+                                                    urllib.quote(start, safe=''), urllib.quote(end, safe=''),
+                                                    urllib.urlencode(sorted(arguments.items()))))
+        if response.code != 200:
+            raise Exception('Unexpected status %s from riak querying %s on %s' % (response.code, index, bucket_name))
+        result = json.loads(body)
+        results = []
+        for entry in result.get('results', []):
+            for term, key in entry.items():
+                results.append((term.encode('utf-8'), key.encode('utf-8')))
+        defer.returnValue((results, result.get('continuation')))
+
+    @defer.inlineCallbacks
+    def list_objects(self, bucket_name, marker = None, prefix = None, max_keys = 5000):
+        """Returns (contents, truncated) from one range query of max_keys + 1 terms"""
+        start, end = term_range(marker, prefix)
+        results, _ = yield self.query(bucket_name, LISTING_INDEX, start, end, max_keys + 1)
+        contents = []
+        for term, _ in results[:max_keys]:
+            object_name, size, last_modified, etag = parse_listing_term(term)
+            content = {
+                        'Key': object_name,
+                        'LastModified': datetime.datetime.fromtimestamp(float(last_modified)),
+                        'Size': size
+                      }
+            if etag:
+                content['ETag'] = '"%s"' % etag
+            contents.append(content)
+        defer.returnValue((contents, len(results) > max_keys))
+
+    def register_bucket(self, bucket_name, creation_date):
+        return self.store(REGISTRY_BUCKET, bucket_name, creation_date,
+                          {BUCKET_INDEX: bucket_term(bucket_name, creation_date)})
+
+    @defer.inlineCallbacks
+    def unregister_bucket(self, bucket_name):
+        response, _ = yield self.nodes.fetch('DELETE', object_url(REGISTRY_BUCKET, bucket_name))
+        if response.code not in (204, 404):
+            raise Exception('Unexpected status %s from riak unregistering %s' % (response.code, bucket_name))
+
+    @defer.inlineCallbacks
+    def list_buckets(self):
+        buckets = []
+        continuation = None
+        while True:
+            results, continuation = yield self.query(REGISTRY_BUCKET, BUCKET_INDEX, '0', 'g', 1000, continuation)
+            buckets.extend(parse_bucket_term(term) for term, _ in results)
+            if not continuation:
+                break
+        defer.returnValue(buckets)
+
+@defer.inlineCallbacks
+def reindex(storage, bucket_names = None):
+    """Adds index terms to buckets and objects written before listings used them"""
+    if not bucket_names:
+        bucket_names = yield storage.riak_client.list_buckets()
+    total = 0
+    for bucket_name in sorted(bucket_names):
+        if bucket_name in storage._private:
+            continue
+        bucket = storage.riak_client.bucket(bucket_name)
+        obj = yield bucket.get_binary('__CreationDate__')
+        if not obj.exists():
+            continue
+        yield storage.index.register_bucket(bucket_name, obj.get_data())
+        count = 0
+        for object_name in (yield bucket.list_keys()):
+            if object_name == '__CreationDate__':
+                continue
+            obj = yield bucket.get_binary(object_name)
+            if not obj.exists():
+                continue
+            yield storage._store_record(bucket_name, object_name, json.loads(obj.get_data()))
+            count += 1
+        print '%s: indexed %d objects' % (bucket_name, count)
+        total += count
+    defer.returnValue(total)
+
+if __name__ == '__main__':
+    from twisted.internet import reactor
+    from otto.storage import RiakObjectStorage
+    parser = OptionParser(usage='%prog [options] [bucket ...]')
+    parser.add_option('--nodes', default='127.0.0.1:8098', help='riak nodes [%default]')
+    options, args = parser.parse_args()
+    storage = RiakObjectStorage.ObjectStorage({'nodes': options.nodes, 'gc_interval': '0',
+                                               'health_check_interval': '0'})
+
+    def run():
+        d = reindex(storage, args)
+        d.addErrback(log.err)
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
@@ -0,0 +1,250 @@
+import json
+import urllib
+import itertools
+from StringIO import StringIO
+from twisted.python import log
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.web import client, http
+from twisted.web.http_headers import Headers
+from otto.storage.riakindex import object_url, _utf8
+
+# failures that say the node is unreachable, not that the request body failed
+NODE_ERRORS = (error.ConnectError, error.TimeoutError, defer.TimeoutError, client.ResponseNeverReceived)
+
+class BodyCollector(protocol.Protocol):
+    def __init__(self, finished):
+        self.finished = finished
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if reason.check(client.ResponseDone, http.PotentialDataLoss):
+            self.finished.callback(''.join(self.data))
+        else:
+            self.finished.errback(reason)
+
+def read_body(response):
+    finished = defer.Deferred()
+    response.deliverBody(BodyCollector(finished))
+    return finished
+
+class ReleasingProtocol(protocol.Protocol):
+    def __init__(self, wrapped, release):
+        self.wrapped = wrapped
+        self.release = release
+
+    def makeConnection(self, transport):
+        self.transport = transport
+        self.wrapped.makeConnection(transport)
+
+    def dataReceived(self, data):
+        self.wrapped.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.release()
+        self.wrapped.connectionLost(reason)
+
+class PooledResponse(object):
+    def __init__(self, response, release):
+        self.response = response
+        self.release = release
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def deliverBody(self, protocol):
+        self.response.deliverBody(ReleasingProtocol(protocol, self.release))
+
+class RiakObject(object):
+    """The parts of txriak's RiakObject otto uses, over the node pool"""
+    def __init__(self, bucket, key, data = None, exists = False, vclock = None):
+        self.bucket = bucket
+        self.key = key
+        self.data = data
+        self._exists = exists
+        self.vclock = vclock
+
+    def exists(self):
+        return self._exists
+
+    def get_data(self):
+        return self.data
+
+    def set_data(self, data):
+        self.data = data
+        return self
+
+    def _headers(self, content_type = None):
+        headers = Headers()
+        if content_type:
+            headers.addRawHeader('Content-Type', content_type)
+        if self.vclock:
+            headers.addRawHeader('X-Riak-Vclock', self.vclock)
+        return headers
+
+    @defer.inlineCallbacks
+    def store(self):
+        response, _ = yield self.bucket.nodes.fetch('PUT', object_url(self.bucket.name, self.key),
+                                                    self._headers('application/octet-stream'),
+                                                    client.FileBodyProducer(StringIO(self.data)))
+        if response.code not in (200, 204):
+            raise Exception('Unexpected status %s from riak storing %s/%s' % (response.code, self.bucket.name, self.key))
+        self._exists = True
+        defer.returnValue(self)
+
+    @defer.inlineCallbacks
+    def delete(self):
+        response, _ = yield self.bucket.nodes.fetch('DELETE', object_url(self.bucket.name, self.key), self._headers())
+        if response.code not in (204, 404):
+            raise Exception('Unexpected status %s from riak deleting %s/%s' % (response.code, self.bucket.name, self.key))
+        self.data = None
+        self._exists = False
+        defer.returnValue(self)
+
+class RiakBucket(object):
+    def __init__(self, nodes, name):
+        self.nodes = nodes
+        self.name = name
+
+    def new_binary(self, key, data):
+        return RiakObject(self, key, data)
+
+    @defer.inlineCallbacks
+    def get_binary(self, key):
+        response, data = yield self.nodes.fetch('GET', object_url(self.name, key))
+        if response.code == 404:
+            defer.returnValue(RiakObject(self, key))
+        if response.code != 200:
+            raise Exception('Unexpected status %s from riak fetching %s/%s' % (response.code, self.name, key))
+        vclock = response.headers.getRawHeaders('X-Riak-Vclock', [None])[0]
+        defer.returnValue(RiakObject(self, key, data, True, vclock))
+
+    @defer.inlineCallbacks
+    def list_keys(self):
+        response, data = yield self.nodes.fetch('GET', 'riak/%s?keys=true&props=false' %
+                                                urllib.quote(_utf8(self.name), safe=''))
+        if response.code != 200:
+            raise Exception('Unexpected status %s from riak listing %s' % (response.code, self.name))
+        defer.returnValue([key.encode('utf-8') for key in json.loads(data).get('keys', [])])
+
+class RiakClient(object):
+    """Stands in for txriak's client so every KV call goes through the pool's
+    node selection, in-flight limit and failure accounting"""
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def bucket(self, name):
+        return RiakBucket(self.nodes, name)
+
+    @defer.inlineCallbacks
+    def list_buckets(self):
+        response, data = yield self.nodes.fetch('GET', 'riak?buckets=true')
+        if response.code != 200:
+            raise Exception('Unexpected status %s from riak listing buckets' % response.code)
+        defer.returnValue([name.encode('utf-8') for name in json.loads(data).get('buckets', [])])
+
+class RiakNode(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+
+    def url(self, path):
+        return 'http://%s:%d/%s' % (self.host, self.port, path.lstrip('/'))
+
+    def __repr__(self):
+        return '%s:%d' % (self.host, self.port)
+
+class RiakNodePool(object):
+    def __init__(self, nodes, strategy = 'round_robin', max_in_flight = 128, connections_per_node = 16,
+                 health_check_interval = 5):
+        self.nodes = []
+        for node in nodes:
+            host, _, port = node.strip().partition(':')
+            self.nodes.append(RiakNode(host, int(port or 8098)))
+        if strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError('Unknown riak node selection strategy %s' % strategy)
+        self.strategy = strategy
+        self._round_robin = itertools.cycle(range(len(self.nodes)))
+        self.connection_pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self.connection_pool.maxPersistentPerHost = connections_per_node
+        self.agent = client.Agent(reactor, pool=self.connection_pool)
+        self.semaphore = defer.DeferredSemaphore(max_in_flight)
+        self.riak_client = RiakClient(self)
+        self.health_check = task.LoopingCall(self.check_health)
+        if health_check_interval > 0:
+            reactor.callWhenRunning(self.health_check.start, health_check_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+        log.msg('Riak node pool %s using %s selection' % (self.nodes, strategy))
+
+    def select(self):
+        nodes = [node for node in self.nodes if node.healthy] or self.nodes
+        if self.strategy == 'least_loaded':
+            return min(nodes, key=lambda node: node.in_flight)
+        for _ in range(len(self.nodes)):
+            node = self.nodes[self._round_robin.next()]
+            if node in nodes:
+                return node
+        return nodes[0]
+
+    @defer.inlineCallbacks
+    def request(self, method, path, headers = None, body = None, node = None):
+        yield self.semaphore.acquire()
+        node = node or self.select()
+        node.in_flight += 1
+        node.requests += 1
+        released = []
+        def release():
+            if not released:
+                released.append(True)
+                node.in_flight -= 1
+                self.semaphore.release()
+        try:
+            response = yield self.agent.request(method, node.url(path), headers or Headers(), body)
+        except NODE_ERRORS, e:
+            release()
+            node.failures += 1
+            node.healthy = False
+            log.msg('Riak node %s failed %s %s: %s' % (node, method, path, e))
+            raise
+        except Exception:
+            release()
+            raise
+        defer.returnValue(PooledResponse(response, release))
+
+    @defer.inlineCallbacks
+    def fetch(self, method, path, headers = None, body = None):
+        response = yield self.request(method, path, headers, body)
+        data = yield read_body(response)
+        defer.returnValue((response, data))
+
+    @defer.inlineCallbacks
+    def check_health(self):
+        for node in self.nodes:
+            try:
+                response = yield self.agent.request('GET', node.url('ping'))
+                yield read_body(response)
+                healthy = response.code == 200
+            except Exception:
+                healthy = False
+            if healthy != node.healthy:
+                log.msg('Riak node %s is now %s' % (node, healthy and 'healthy' or 'unhealthy'))
+            node.healthy = healthy
+
+    def stats(self):
+        return dict((repr(node), {
+                                    'healthy': node.healthy,
+                                    'in_flight': node.in_flight,
+                                    'requests': node.requests,
+                                    'failures': node.failures
+                                 }) for node in self.nodes)
+
+    def close(self):
+        if self.health_check.running:
+            self.health_check.stop()
+        return self.connection_pool.closeCachedConnections()